@@ -0,0 +1,291 @@
+"""Incremental rebuilds of card image sets.
+
+A build manifest records, for every output image, what it was rendered from: the card
+EDN and the data files filled into it, the template YAML keys, template images, fonts
+and background image, each with a digest. plan_rebuild compares that with what's on disk
+now, optionally only looking at a change set (touched files or a git range), and says
+which outputs need rendering again and why - e.g. editing assets/ice/ice_hb.png only
+plans HB ICE, and editing the trashcan atom only cards with a trash cost.
+
+    python card_build_plan.py outdir/manifest.json --since HEAD~3 --dry-run
+"""
+import argparse
+import functools
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Iterable, NamedTuple, Optional
+
+import yaml
+
+import proxygen
+from card_render_cache import RenderCache, content_key, file_digest
+
+# 2: card_digest covers the set symbol and number too
+# 3: renderer digests are recorded per output
+MANIFEST_VERSION = 3
+
+# Editing any of these can change any card, so every output records them: the renderer,
+# and the modules it imports which read the card data and templates or encode images
+RENDERER_SOURCES = [
+    Path(proxygen.__file__).resolve().with_name(name)
+    for name in ["proxygen.py", "card_templates.py", "card_encoders.py", "card_edn.py", "card_metadata.py", "carddb.py"]
+]
+
+
+class ManifestEntry(NamedTuple):
+    """How an output image was rendered, and digests of everything it was rendered from."""
+
+    # render_card arguments, so the output can be rendered again
+    edn_path: str
+    card_code: Optional[str]
+    background_img_path: Optional[str]
+    make_alt: bool
+    fudge_factor: Optional[float]
+    card_digest: str  # of the card dict after prepare_card_dict, and its set symbol and number
+    card_sources: dict[str, Optional[str]]  # the EDN and data files the card dict is made from
+    files: dict[str, Optional[str]]  # template YAML and images, fonts, background image
+    template_path: Optional[str]
+    template_keys: dict[str, str]  # digest of the value of each template YAML key used
+    renderer: dict[str, Optional[str]]  # RENDERER_SOURCES, as they were when it was rendered
+
+
+class PlannedOutput(NamedTuple):
+    output_path: str
+    reasons: list[str]
+
+
+class BuildPlan(NamedTuple):
+    rebuild: list[PlannedOutput]
+    skipped: list[str]  # up to date
+
+
+def _digest_or_none(path) -> Optional[str]:
+    """Missing files get recorded too (some templates refer to atoms which don't exist)."""
+    return file_digest(path) if Path(path).exists() else None
+
+
+@functools.lru_cache(maxsize=64)
+def _template_key_digests(path: str, mtime_ns: int) -> dict[str, str]:
+    raw = yaml.safe_load(Path(path).read_text())
+    digests = {}
+    for key, value in raw.items():
+        if key == "atoms":
+            for atom, relpath in value.items():
+                digests[f"atoms.{atom}"] = content_key(relpath)
+        else:
+            digests[key] = content_key(json.dumps(value, sort_keys=True, default=str))
+    return digests
+
+
+def template_key_digests(path) -> dict[str, str]:
+    """Digest of each top-level key of a template YAML, so edits to one item don't rebuild every card."""
+    path = Path(path)
+    return _template_key_digests(str(path), path.stat().st_mtime_ns)
+
+
+def card_digest(card_dict, card_code: str) -> str:
+    """The card dict, and the set symbol and number card_template fills in, which depend on
+    whether the card is in changed_card_codes.json."""
+    return content_key(proxygen.card_dict_digest(card_dict), proxygen.set_sym_num(card_code))
+
+
+def renderer_digests() -> dict[str, Optional[str]]:
+    return {str(path): _digest_or_none(path) for path in RENDERER_SOURCES}
+
+
+def make_entry(
+    edn_path,
+    card_code: Optional[str] = None,
+    background_img_path: Optional[str] = None,
+    make_alt: bool = False,
+    fudge_factor: Optional[float] = None,
+) -> ManifestEntry:
+    """Record what render_card with these arguments uses. Call it after rendering the output."""
+    edn_path = Path(edn_path).resolve()
+    card_dict, resolved_code, resolved_fudge = proxygen.prepare_card_dict(
+        edn_path, fudge_factor, card_code, make_alt
+    )
+    background = proxygen.card_background(resolved_code, edn_path.stem, background_img_path)
+    inputs = proxygen.render_inputs(card_dict, background, make_alt=make_alt, card_code=resolved_code)
+    card_sources = [edn_path, proxygen.ILLUSTRATOR_DICT_PATH, proxygen.CHANGED_CARD_CODES_PATH]
+    if card_code is None:
+        card_sources.append(proxygen.CODE_DICT_PATH)
+    if inputs.template_path is None:
+        template_keys = {}
+    else:
+        all_keys = template_key_digests(inputs.template_path)
+        template_keys = {key: all_keys[key] for key in inputs.template_keys if key in all_keys}
+    return ManifestEntry(
+        edn_path=str(edn_path),
+        card_code=card_code,
+        background_img_path=str(Path(background_img_path).resolve()) if background_img_path else None,
+        make_alt=make_alt,
+        fudge_factor=fudge_factor,
+        card_digest=card_digest(card_dict, resolved_code),
+        card_sources={str(Path(p).resolve()): _digest_or_none(p) for p in card_sources},
+        files={str(p.resolve()): _digest_or_none(p) for p in inputs.files if p != inputs.template_path},
+        template_path=str(inputs.template_path.resolve()) if inputs.template_path else None,
+        template_keys=template_keys,
+        renderer=renderer_digests(),
+    )
+
+
+def load_manifest(path) -> dict:
+    """A manifest is {"version", "outputs": {output path: ManifestEntry}}. Missing is empty."""
+    path = Path(path)
+    if not path.exists():
+        return {"version": MANIFEST_VERSION, "outputs": {}}
+    raw = json.loads(path.read_text())
+    if raw.get("version") != MANIFEST_VERSION:
+        # everything gets planned, and recorded afresh
+        return {"version": MANIFEST_VERSION, "outputs": {}}
+    raw["outputs"] = {out: ManifestEntry(**entry) for out, entry in raw["outputs"].items()}
+    return raw
+
+
+def save_manifest(path, manifest: dict):
+    path = Path(path)
+    data = {
+        "version": MANIFEST_VERSION,
+        "outputs": {out: entry._asdict() for out, entry in sorted(manifest["outputs"].items())},
+    }
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(data, indent=1))
+    tmp_path.replace(path)
+
+
+def record(manifest: dict, output_path, *args, **kwargs):
+    """Add (or update) an output in the manifest, see make_entry for the arguments."""
+    manifest["outputs"][str(Path(output_path).resolve())] = make_entry(*args, **kwargs)
+
+
+def git_changed_files(rev_range: str) -> set[Path]:
+    """Files changed in a git range like A..B. A single revision compares it to the working tree."""
+    toplevel = Path(
+        subprocess.check_output(["git", "rev-parse", "--show-toplevel"], text=True).strip()
+    )
+    revs = rev_range.split("..") if ".." in rev_range else [rev_range]
+    names = subprocess.check_output(["git", "diff", "--name-only", *revs], text=True, cwd=toplevel)
+    return {(toplevel / name).resolve() for name in names.splitlines()}
+
+
+def _changed_digests(recorded: dict[str, Optional[str]], changed: Optional[set[str]]) -> list[str]:
+    return [
+        path
+        for path, digest in recorded.items()
+        if (changed is None or path in changed) and _digest_or_none(path) != digest
+    ]
+
+
+def plan_entry(output_path: str, entry: ManifestEntry, changed: Optional[set[str]] = None) -> list[str]:
+    """Why an output needs rendering again, if it does."""
+    if not Path(output_path).exists():
+        return ["output missing"]
+    reasons = [f"changed {path}" for path in _changed_digests(entry.files, changed)]
+
+    if entry.template_path and (changed is None or entry.template_path in changed):
+        current = template_key_digests(entry.template_path)
+        reasons += [
+            f"changed {Path(entry.template_path).name}:{key}"
+            for key, digest in entry.template_keys.items()
+            if current.get(key) != digest
+        ]
+
+    # Data files are shared by every card, so only rebuild if this card's data is what changed
+    if _changed_digests(entry.card_sources, changed):
+        try:
+            card_dict, card_code, _ = proxygen.prepare_card_dict(
+                entry.edn_path, entry.fudge_factor, entry.card_code, entry.make_alt
+            )
+            digest = card_digest(card_dict, card_code)
+        except Exception as e:
+            return reasons + [f"card data unreadable ({type(e).__name__}: {e})"]
+        if digest != entry.card_digest:
+            reasons.append(f"changed card data ({Path(entry.edn_path).name})")
+    return reasons
+
+
+def plan_rebuild(manifest: dict, changed: Optional[Iterable] = None) -> BuildPlan:
+    """Work out which outputs in the manifest are out of date.
+
+    changed is a change set of files to look at (other files are assumed unchanged),
+    by default every recorded digest is checked against the file on disk."""
+    changed = None if changed is None else {str(Path(p).resolve()) for p in changed}
+    renderer = renderer_digests()
+    rebuild, skipped = [], []
+    for output_path, entry in manifest["outputs"].items():
+        # outputs which failed or weren't made last time still have the renderer they were made with
+        reasons = [
+            f"changed {Path(path).name}" for path, digest in renderer.items() if entry.renderer.get(path) != digest
+        ]
+        reasons += plan_entry(output_path, entry, changed)
+        if reasons:
+            rebuild.append(PlannedOutput(output_path, reasons))
+        else:
+            skipped.append(output_path)
+    return BuildPlan(rebuild, skipped)
+
+
+def rebuild(manifest: dict, plan: BuildPlan, cache: Optional[RenderCache] = None) -> list[tuple[str, str]]:
+    """Render the planned outputs again and record them in the manifest. Returns (output, error) for failures."""
+    failures = []
+    for planned in plan.rebuild:
+        entry = manifest["outputs"][planned.output_path]
+        args = (entry.edn_path, entry.card_code, entry.background_img_path, entry.make_alt, entry.fudge_factor)
+        try:
+            proxygen.render_card(
+                entry.edn_path,
+                planned.output_path,
+                background_img_path=entry.background_img_path,
+                fudge_factor=entry.fudge_factor,
+                card_code=entry.card_code,
+                make_alt=entry.make_alt,
+                cache=cache,
+            )
+            record(manifest, planned.output_path, *args)
+        except Exception as e:
+            failures.append((planned.output_path, f"{type(e).__name__}: {e}"))
+    return failures
+
+
+def print_plan(plan: BuildPlan, file=sys.stdout):
+    for planned in plan.rebuild:
+        print(f"{planned.output_path}: {', '.join(planned.reasons)}", file=file)
+    print(f"\nPlanned {len(plan.rebuild)} outputs, skipped {len(plan.skipped)} up to date", file=file)
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(
+        description="Render again exactly the outputs in a build manifest affected by a change."
+    )
+    parser.add_argument("manifest", help="build manifest, as written by make_proxies.py")
+    changes = parser.add_mutually_exclusive_group()
+    changes.add_argument("--since", help="git range (A..B), or a revision to compare the working tree to")
+    changes.add_argument("--changed", nargs="+", help="files which were changed")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="only report what would be rendered")
+    parser.add_argument("--cache-dir", help="render cache to use, see card_render_cache.py")
+    args = parser.parse_args(argv)
+
+    manifest = load_manifest(args.manifest)
+    changed = git_changed_files(args.since) if args.since else args.changed
+    start = time.perf_counter()
+    plan = plan_rebuild(manifest, changed)
+    print_plan(plan)
+    print(f"Planning took {time.perf_counter() - start:.2f}s")
+    if args.dry_run or not plan.rebuild:
+        return 0
+
+    start = time.perf_counter()
+    failures = rebuild(manifest, plan, cache=RenderCache(args.cache_dir) if args.cache_dir else None)
+    save_manifest(args.manifest, manifest)
+    for output_path, error in failures:
+        print(f"{output_path}: FAILED {error}")
+    print(f"Rendered {len(plan.rebuild) - len(failures)} outputs in {time.perf_counter() - start:.2f}s")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
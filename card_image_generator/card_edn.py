@@ -0,0 +1,113 @@
+"""A small, fast reader for the EDN in the edn/ tree.
+
+edn_format is a complete EDN parser built on PLY, and slow with it: reading the tree
+takes seconds. The card data only uses maps, vectors, lists, keywords, strings, numbers,
+nil and booleans, which this reads straight into plain Python values - dicts, lists, and
+keywords as strings without the colon - so there's nothing left to pyfy. Anything else
+(sets, tags, symbols, characters) is an error rather than a silent misreading.
+
+    card_edn.read(EDN_DIR / "cards" / "ice-wall.edn")["subtype"] == ["barrier"]
+"""
+import re
+from pathlib import Path
+from typing import Any, Iterator
+
+_DELIMITER = r"""\s,\[\]{}()"';"""
+_TOKEN = re.compile(
+    rf"""
+    [\s,]*(?:;[^\n]*[\s,]*)*  # whitespace and comments before every token
+    (?:  # most common first
+      :(?P<keyword>[^{_DELIMITER}:][^{_DELIMITER}]*)
+    | "(?P<string>[^"\\]*(?:\\.[^"\\]*)*)"
+    | (?P<int>[-+]?\d+)(?![^{_DELIMITER}])
+    | (?P<open>[\[{{(])
+    | (?P<close>[\]}})])
+    | (?P<float>[-+]?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)(?![^{_DELIMITER}])
+    | (?P<symbol>[^{_DELIMITER}\#][^{_DELIMITER}]*)
+    )?
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+_ESCAPE = re.compile(r"\\(u[0-9a-fA-F]{4}|.)", re.DOTALL)
+_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f", '"': '"', "\\": "\\"}
+_SYMBOLS = {"nil": None, "true": True, "false": False}
+_CLOSING = {"[": "]", "(": ")", "{": "}"}
+
+
+class EDNError(ValueError):
+    pass
+
+
+def _unescape(match: re.Match) -> str:
+    escape = match.group(1)
+    if escape[0] == "u" and len(escape) == 5:
+        return chr(int(escape[1:], 16))
+    try:
+        return _ESCAPES[escape]
+    except KeyError:
+        raise EDNError(f"unsupported string escape \\{escape}") from None
+
+
+def _line(text: str, pos: int) -> int:
+    return text.count("\n", 0, pos) + 1
+
+
+def iter_forms(text: str) -> Iterator[Any]:
+    """Yield the top-level forms of text one by one."""
+    # (opening bracket, position, items) of every collection being read
+    stack: list[tuple[str, int, list]] = []
+    items = None  # of the innermost collection
+    pos, end = 0, len(text)
+    match = _TOKEN.match
+    while True:
+        m = match(text, pos)
+        kind = m.lastgroup
+        if kind is None:
+            if m.end() == end:
+                break
+            raise EDNError(f"unsupported EDN {text[m.end():m.end() + 20]!r} on line {_line(text, m.end())}")
+        pos = m.end()
+        if kind == "keyword":
+            value = m.group(kind)
+        elif kind == "string":
+            value = m.group(kind)
+            if "\\" in value:
+                value = _ESCAPE.sub(_unescape, value)
+        elif kind == "int":
+            value = int(m.group(kind))
+        elif kind == "open":
+            items = []
+            stack.append((m.group(kind), m.start(kind), items))
+            continue
+        elif kind == "close":
+            if not stack or _CLOSING[stack[-1][0]] != m.group(kind):
+                raise EDNError(f"unexpected {m.group(kind)!r} on line {_line(text, m.start(kind))}")
+            bracket, start, value = stack.pop()
+            if bracket == "{":
+                if len(value) % 2:
+                    raise EDNError(f"map with an odd number of forms on line {_line(text, start)}")
+                value = dict(zip(value[::2], value[1::2]))
+            items = stack[-1][2] if stack else None
+        elif kind == "float":
+            value = float(m.group(kind))
+        else:
+            symbol = m.group(kind)
+            if symbol not in _SYMBOLS:
+                raise EDNError(f"unsupported symbol {symbol!r} on line {_line(text, m.start(kind))}")
+            value = _SYMBOLS[symbol]
+
+        if items is not None:
+            items.append(value)
+        else:
+            yield value
+    if stack:
+        raise EDNError(f"unclosed {stack[-1][0]!r} from line {_line(text, stack[-1][1])}")
+
+
+def loads(text: str) -> Any:
+    """The first form in text (a file holds one), None if there isn't one."""
+    return next(iter_forms(text), None)
+
+
+def read(path) -> Any:
+    return loads(Path(path).read_text(encoding="utf-8"))
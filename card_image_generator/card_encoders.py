@@ -0,0 +1,154 @@
+"""Encoding rendered cards: output formats, per-use-case quality presets, and a small
+thread pool so encoding doesn't hold up rendering the next card."""
+import io
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from PIL import Image, features
+
+
+class ImageFormat(str, Enum):
+    JPEG = "jpeg"
+    PNG = "png"
+    WEBP = "webp"
+    AVIF = "avif"
+
+    @property
+    def mimetype(self) -> str:
+        return f"image/{self.value}"
+
+    @property
+    def suffix(self) -> str:
+        return ".jpg" if self == ImageFormat.JPEG else f".{self.value}"
+
+
+SUFFIX_FORMATS = {
+    ".jpg": ImageFormat.JPEG,
+    ".jpeg": ImageFormat.JPEG,
+    ".png": ImageFormat.PNG,
+    ".webp": ImageFormat.WEBP,
+    ".avif": ImageFormat.AVIF,
+}
+
+
+class Preset(NamedTuple):
+    jpeg_quality: int
+    jpeg_progressive: bool
+    jpeg_optimize: bool
+    png_compress_level: int
+    webp_quality: int
+    webp_method: int  # 0-6, slower is smaller
+    avif_quality: int
+    avif_speed: int  # 0-10, faster is bigger
+
+
+PRESETS = {
+    # what proxygen.py has always written
+    "print": Preset(
+        jpeg_quality=95,
+        jpeg_progressive=False,
+        jpeg_optimize=False,
+        png_compress_level=6,
+        webp_quality=95,
+        webp_method=6,
+        avif_quality=90,
+        avif_speed=6,
+    ),
+    # the web form, where encoding time is part of the response time
+    "web": Preset(
+        jpeg_quality=85,
+        jpeg_progressive=True,
+        jpeg_optimize=True,
+        png_compress_level=1,
+        webp_quality=80,
+        webp_method=2,
+        avif_quality=60,
+        avif_speed=8,
+    ),
+    "thumbnail": Preset(
+        jpeg_quality=75,
+        jpeg_progressive=False,
+        jpeg_optimize=True,
+        png_compress_level=6,
+        webp_quality=70,
+        webp_method=4,
+        avif_quality=50,
+        avif_speed=6,
+    ),
+}
+
+
+def is_supported(fmt: ImageFormat) -> bool:
+    """WebP and AVIF depend on how Pillow was built."""
+    if fmt in {ImageFormat.JPEG, ImageFormat.PNG}:
+        return True
+    try:
+        return bool(features.check(fmt.value))
+    except ValueError:  # Pillow too old to know about the codec at all
+        return False
+
+
+def format_for_path(path) -> ImageFormat:
+    suffix = Path(path).suffix.lower()
+    if suffix not in SUFFIX_FORMATS:
+        raise ValueError(f"Don't know which image format to use for {path}")
+    return SUFFIX_FORMATS[suffix]
+
+
+def save_options(fmt: ImageFormat, preset: str) -> dict:
+    p = PRESETS[preset]
+    if fmt == ImageFormat.JPEG:
+        return {
+            "format": "JPEG",
+            "quality": p.jpeg_quality,
+            "optimize": p.jpeg_optimize,
+            "progressive": p.jpeg_progressive,
+        }
+    if fmt == ImageFormat.PNG:
+        return {"format": "PNG", "compress_level": p.png_compress_level}
+    if fmt == ImageFormat.WEBP:
+        return {"format": "WEBP", "quality": p.webp_quality, "method": p.webp_method}
+    return {"format": "AVIF", "quality": p.avif_quality, "speed": p.avif_speed}
+
+
+def encode(img: Image.Image, fmt: ImageFormat, preset: str = "web") -> bytes:
+    """Encode a rendered card. Cards are flattened to RGB, like they always have been
+    (this also applies the transparency mask from the template, PIL is weird about it otherwise)."""
+    assert is_supported(fmt), f"This Pillow can't write {fmt.value}"
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, **save_options(fmt, preset))
+    return buf.getvalue()
+
+
+def save_image(img: Image.Image, path, preset: str = "print", fmt: Optional[ImageFormat] = None):
+    """Save a rendered card, in the format given by the file suffix unless fmt is given."""
+    Path(path).write_bytes(encode(img, fmt or format_for_path(path), preset))
+
+
+# Encoding (zlib/libjpeg/libwebp) releases the GIL, so a couple of threads is enough to keep up
+ENCODER_THREADS = 2
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def encoder_pool() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=ENCODER_THREADS, thread_name_prefix="encoder")
+        return _executor
+
+
+def encode_in_background(img: Image.Image, fmt: ImageFormat, preset: str = "web") -> Future:
+    """Like encode, in the encoder pool. img must not be modified afterwards."""
+    return encoder_pool().submit(encode, img, fmt, preset)
+
+
+def save_in_background(img: Image.Image, path, preset: str = "print", fmt: Optional[ImageFormat] = None) -> Future:
+    """Like save_image, in the encoder pool. img must not be modified afterwards."""
+    return encoder_pool().submit(save_image, img, path, preset, fmt)
@@ -0,0 +1,98 @@
+"""Card metadata which isn't part of the card EDN - codes, printings, illustrators, flavor
+text and which cards were changed - precompiled into a single snapshot.
+
+Reading the JSON sources takes a while (and the code dict used to go through the YAML
+parser), so they are merged once into a pickle next to them. Loading that is a couple of
+milliseconds, and it is rebuilt whenever one of the sources changes."""
+import errno
+import json
+import os
+import pickle
+import threading
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+# Bump when CardMetadata changes, so old snapshots get rebuilt
+# 2: missing sources are None rather than empty
+SNAPSHOT_VERSION = 2
+
+
+class CardMetadata(NamedTuple):
+    """None for a source which is missing, see require."""
+
+    codes: Optional[dict[str, str]]  # card id -> card code
+    printings: Optional[dict[str, str]]  # card code -> code of its first printing
+    illustrators: Optional[dict[str, dict[str, str]]]  # card code -> {"illustrator": ..., "flavor": ...}
+    changed_codes: frozenset[str]  # codes of cards changed in the reboot
+
+
+class MetadataSources(NamedTuple):
+    """The files a snapshot is made from. Only changed_codes may be missing (no cards changed),
+    the others raise when they're used."""
+
+    codes: Path
+    printings: Path
+    illustrators: Path
+    changed_codes: Path
+
+
+def _read_json(path: Path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def require(value, path: Path):
+    """A CardMetadata field, or FileNotFoundError if its source (at path) was missing."""
+    if value is None:
+        raise FileNotFoundError(errno.ENOENT, "Card metadata source missing", str(path))
+    return value
+
+
+def _source_stamps(sources: MetadataSources) -> list[Optional[tuple[str, int, int]]]:
+    stamps = []
+    for path in sources:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            stamps.append(None)
+            continue
+        stamps.append((str(Path(path).resolve()), st.st_mtime_ns, st.st_size))
+    return stamps
+
+
+def compile_metadata(sources: MetadataSources) -> CardMetadata:
+    return CardMetadata(
+        codes=_read_json(sources.codes),
+        printings=_read_json(sources.printings),
+        illustrators=_read_json(sources.illustrators),
+        changed_codes=frozenset(_read_json(sources.changed_codes) or []),
+    )
+
+
+_write_lock = threading.Lock()
+
+
+def load_metadata(snapshot_path: Path, sources: MetadataSources) -> CardMetadata:
+    """Load the snapshot, (re)compiling it from sources if it's missing or out of date."""
+    stamps = _source_stamps(sources)
+    try:
+        with open(snapshot_path, "rb") as f:
+            version, snapshot_stamps, metadata = pickle.load(f)
+        if version == SNAPSHOT_VERSION and snapshot_stamps == stamps:
+            return metadata
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, AttributeError):
+        pass
+
+    metadata = compile_metadata(sources)
+    try:
+        with _write_lock:
+            tmp_path = Path(snapshot_path).with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as f:
+                pickle.dump((SNAPSHOT_VERSION, stamps, metadata), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, snapshot_path)
+    except OSError:  # read-only checkout, just go without
+        pass
+    return metadata
@@ -0,0 +1,144 @@
+"""Where render time goes, card by card.
+
+Rendering code marks stages with span("name") and counts work with count("name"). Both
+do nothing unless a Profile is active in the thread, so they can stay in the hot path.
+Spans nest, and a parent's time includes its children's.
+
+    profile = Profile()
+    with profile.active():
+        make_card_proxy(...)
+    profile.spans  # {"textbox": 0.21, "textbox.fit": 0.18, ...} in seconds
+
+The records of a batch rendered with --profile go to a JSON lines file, which this
+summarises by card type and faction:
+
+    python card_profile.py profile.jsonl
+"""
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Iterable, Optional
+
+_local = threading.local()
+_NOT_PROFILING = nullcontext()
+# How many spans print_report lists for each type and faction
+REPORT_SPANS = 8
+
+
+class Profile:
+    def __init__(self):
+        self.spans: dict[str, float] = defaultdict(float)  # seconds, summed over every time it was entered
+        self.counters: dict[str, int] = defaultdict(int)
+        self._stack: list[str] = []
+
+    @contextmanager
+    def active(self):
+        """Record the spans and counts of this thread into the profile."""
+        previous = getattr(_local, "profile", None)
+        _local.profile = self
+        try:
+            yield self
+        finally:
+            _local.profile = previous
+
+    @contextmanager
+    def _span(self, name: str):
+        # named by where it is nested, e.g. textbox.fit
+        full_name = f"{self._stack[-1]}.{name}" if self._stack else name
+        self._stack.append(full_name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[full_name] += time.perf_counter() - start
+            self._stack.pop()
+
+    def as_dict(self) -> dict:
+        return {
+            # time spent in (top level) spans, which is nearly all of rendering
+            "ms": round(1000 * sum(t for name, t in self.spans.items() if "." not in name), 3),
+            "spans": {name: round(1000 * seconds, 3) for name, seconds in self.spans.items()},
+            "counters": dict(self.counters),
+        }
+
+
+def activated(profile: Optional[Profile]):
+    """profile.active(), or nothing if there is no profile."""
+    return _NOT_PROFILING if profile is None else profile.active()
+
+
+def call_in(profile: Optional[Profile], fn, *args):
+    """fn(*args) with profile active, for work handed to another thread."""
+    with activated(profile):
+        return fn(*args)
+
+
+def span(name: str):
+    """Context manager timing a stage of rendering into the active profile, if any."""
+    profile = getattr(_local, "profile", None)
+    return _NOT_PROFILING if profile is None else profile._span(name)
+
+
+def count(name: str, n: int = 1):
+    profile = getattr(_local, "profile", None)
+    if profile is not None:
+        profile.counters[name] += n
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile, q in 0-100."""
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, round(q / 100 * len(values)) - 1))]
+
+
+def read_records(path) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def print_report(records: Iterable[dict], file=sys.stdout):
+    """p50/p95 of the total and of the slowest spans (in ms) by card type and faction."""
+    records = [r for r in records if "spans" in r and not r.get("error") and not r.get("cached")]
+    if not records:
+        print("No rendered cards to report on", file=file)
+        return
+    for group_by in ("type", "faction"):
+        groups = defaultdict(list)
+        for record in records:
+            groups[record.get(group_by) or "?"].append(record)
+        print(f"\nBy {group_by}:", file=file)
+        print(f"{'':<30}{'cards':>6}{'p50 ms':>10}{'p95 ms':>10}", file=file)
+        for name, group in sorted(groups.items(), key=lambda g: -percentile([r["ms"] for r in g[1]], 50)):
+            totals = [r["ms"] for r in group]
+            print(f"{name:<30}{len(group):>6}{percentile(totals, 50):>10.1f}{percentile(totals, 95):>10.1f}", file=file)
+            span_names = {span for r in group for span in r["spans"]}
+            span_times = {span: [r["spans"].get(span, 0.0) for r in group] for span in span_names}
+            for span_name in sorted(span_names, key=lambda s: -percentile(span_times[s], 50))[:REPORT_SPANS]:
+                times = span_times[span_name]
+                print(
+                    f"  {span_name:<28}{'':>6}{percentile(times, 50):>10.1f}{percentile(times, 95):>10.1f}",
+                    file=file,
+                )
+
+    counters = defaultdict(list)
+    for record in records:
+        for name, value in record["counters"].items():
+            counters[name].append(value)
+    if counters:
+        print(f"\n{'counter (per card)':<30}{'total':>8}{'p50':>8}{'p95':>8}", file=file)
+        for name, values in sorted(counters.items()):
+            # cards which never counted this count as 0
+            values += [0] * (len(records) - len(values))
+            print(
+                f"{name:<30}{sum(values):>8}{percentile(values, 50):>8}{percentile(values, 95):>8}", file=file
+            )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python card_profile.py profile.jsonl")
+        sys.exit(1)
+    print_report(read_records(sys.argv[1]))
@@ -0,0 +1,112 @@
+"""Content-addressed cache of encoded card images on disk.
+
+Entries are named by a hash of everything that went into rendering them (see
+proxygen.render_cache_key), so there is nothing to invalidate: a changed card, template
+or font just hashes to a different entry, and stale entries age out of the size bound.
+Several processes can share one cache directory."""
+import hashlib
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+
+_digest_lock = threading.Lock()
+# path -> (mtime_ns, size, sha256), so unchanged files are only hashed once per process
+_file_digests: dict[str, tuple[int, int, str]] = {}
+
+
+def file_digest(path) -> str:
+    """sha256 of a file's contents, re-hashed only when its mtime or size changes."""
+    path = str(path)
+    st = os.stat(path)
+    with _digest_lock:
+        cached = _file_digests.get(path)
+    if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(2**20):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _digest_lock:
+        _file_digests[path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
+def content_key(*parts) -> str:
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+class RenderCache:
+    """Encoded images in cache_dir, evicting the least recently used once they take up more than max_bytes."""
+
+    def __init__(self, cache_dir, max_bytes: int = 2 * 2**30):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size: Optional[int] = None  # of the whole directory, counted lazily
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def path(self, key: str, suffix: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}{suffix}"
+
+    def get(self, key: str, suffix: str) -> Optional[bytes]:
+        path = self.path(key, suffix)
+        try:
+            data = path.read_bytes()
+            # the mtime is what eviction goes by
+            os.utime(path)
+        except FileNotFoundError:  # never rendered, or evicted (possibly by another process)
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, suffix: str, data: bytes):
+        path = self.path(key, suffix)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self) -> list[tuple[float, int, Path]]:
+        entries = []
+        for path in self.cache_dir.glob("*/*"):
+            if path.name.startswith("."):
+                continue
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache is at 90% of max_bytes."""
+        entries = sorted(self._entries())
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= 0.9 * self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            self._size -= size
+            self.evictions += 1
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": self._size or 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,366 @@
+"""Rendering a whole set on every core.
+
+Workers are started once and preloaded with the templates, fonts and card metadata, so
+no task pays for a cold start. Jobs are handed out in chunks, most expensive first so
+the slow cards don't end up alone at the tail of the run. Workers send back encoded
+images, which the parent writes out as they arrive.
+
+BoundedPool is the web app's version: workers started from a fork server, so never forked
+from the server's threads. The fork server warms up once for all of them (card_web_preload),
+and if it couldn't, each worker warms itself up with warm_up_web. They sit behind a queue of
+bounded depth that turns requests away when it's full instead of growing."""
+import gc
+import math
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional
+
+from PIL import Image
+
+import proxygen
+from card_encoders import ImageFormat, encode, format_for_path
+from card_profile import Profile, activated
+from card_render_cache import RenderCache
+
+# Recycle workers after this many chunks of jobs, since Pillow and FreeType never hand memory back to the OS
+MAX_TASKS_PER_WORKER = 50
+# Workers drop their caches when they grow past this
+WORKER_MEMORY_LIMIT = 1536 * 2**20
+
+
+class RenderSettings(NamedTuple):
+    """What render_batch would be called with, for all the jobs handed to a pool."""
+
+    output_dir: Path
+    suffix: str = "jpg"
+    background_img_path: Optional[str] = None
+    fudge_factor: Optional[float] = None
+    make_alt: bool = False
+    scale: float = 1.0
+    preset: str = "print"
+    cache_dir: Optional[str] = None
+    cache_max_bytes: int = 2 * 2**30
+    memory_limit: int = WORKER_MEMORY_LIMIT
+    profile: bool = False
+    # proxygen.LAYER_CACHE_DIR and BACKGROUND_CACHE_DIR in the workers
+    layer_cache_dir: Optional[str] = None
+    background_cache_dir: Optional[str] = None
+
+
+_settings: Optional[RenderSettings] = None
+_cache: Optional[RenderCache] = None
+
+
+def preload(scale: float = 1.0):
+    """Load what rendering any card needs: every template with its fonts and atoms, and the card metadata.
+    Template images are left to the layer cache, which holds what a worker actually renders."""
+    proxygen.warm_up(scale, template_images=False)
+    try:
+        proxygen.load_code_dict()
+        proxygen.load_illustrator_dict()
+    except OSError:  # only needed for cards without a known code, which fail the same way when rendered
+        pass
+
+
+def worker_init(settings: RenderSettings):
+    global _settings, _cache
+    _settings = settings
+    _cache = RenderCache(settings.cache_dir, settings.cache_max_bytes) if settings.cache_dir else None
+    # a quarter of the budget for the layers, rendering a card takes some too
+    proxygen.LAYER_CACHE.maxsize = settings.memory_limit // 4
+    proxygen.LAYER_CACHE_DIR = Path(settings.layer_cache_dir) if settings.layer_cache_dir else None
+    proxygen.BACKGROUND_CACHE_DIR = Path(settings.background_cache_dir) if settings.background_cache_dir else None
+    preload(settings.scale)
+
+
+def rss_bytes() -> int:
+    """Resident memory of this process (Linux only, 0 elsewhere)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+def trim_memory(limit: int):
+    if rss_bytes() > limit:
+        for cache in [proxygen.LAYER_CACHE, proxygen.TEMPLATE_IMAGE_CACHE, proxygen.LAYOUT_CACHE, proxygen.FONT_CACHE]:
+            cache.clear()
+        gc.collect()
+
+
+def render_job(job: proxygen.BatchJob) -> tuple[proxygen.BatchResult, Optional[bytes]]:
+    """Render and encode one job in a worker. The parent writes the output."""
+    s = _settings
+    output_path = Path(s.output_dir) / f"{job.output_stem}.{s.suffix}"
+    t0 = time.perf_counter()
+    stats = {"worker": os.getpid()}
+    if s.profile:
+        stats["profile"] = Profile()
+    data = error = None
+    try:
+        fmt = format_for_path(output_path)
+        with activated(stats.get("profile")):
+            rendered = proxygen.render_or_fetch(
+                job.edn_path, fmt, s.background_img_path, s.fudge_factor, job.card_code, s.make_alt, stats,
+                s.scale, s.preset, _cache,
+            )
+            data = rendered.data
+            if data is None:
+                data = proxygen.encode_rendered(rendered.image, fmt, s.preset, _cache, rendered.cache_key)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    trim_memory(s.memory_limit)
+    return proxygen.BatchResult(job, output_path, time.perf_counter() - t0, error, stats), data
+
+
+def estimated_cost(job: proxygen.BatchJob) -> float:
+    """Text fitting dominates the differences between cards, so the longer the EDN, the slower the card."""
+    try:
+        return job.edn_path.stat().st_size
+    except OSError:
+        return 0
+
+
+def render_parallel(
+    jobs: list[proxygen.BatchJob],
+    settings: RenderSettings,
+    processes: Optional[int] = None,
+    max_tasks_per_worker: int = MAX_TASKS_PER_WORKER,
+) -> Iterator[proxygen.BatchResult]:
+    """Render jobs on a pool of preloaded workers, writing outputs and yielding results as they finish."""
+    processes = processes or os.cpu_count() or 1
+    Path(settings.output_dir).mkdir(exist_ok=True, parents=True)
+    jobs = sorted(jobs, key=estimated_cost, reverse=True)
+    # small enough chunks to keep every worker busy until the end, big enough to not wait on the parent
+    chunksize = max(1, len(jobs) // (processes * 8))
+    with multiprocessing.Pool(
+        processes, initializer=worker_init, initargs=(settings,), maxtasksperchild=max_tasks_per_worker
+    ) as pool:
+        for result, data in pool.imap_unordered(render_job, jobs, chunksize=chunksize):
+            if data is not None:
+                try:
+                    result.output_path.write_bytes(data)
+                except OSError as e:
+                    result = result._replace(error=f"{type(e).__name__}: {e}")
+            yield result
+
+
+class WebWarmUp(NamedTuple):
+    """What a web app process loads before serving, see warm_up_web."""
+
+    scales: tuple[float, ...]  # every template with its fonts and atoms, at each of these
+    template_image_scales: tuple[float, ...]  # and the template images, at these
+    template_image_cache_bytes: int
+    card: dict  # rendered and encoded at each scale, for whatever else gets loaded lazily
+    formats: tuple[ImageFormat, ...]
+
+
+_web_state: dict = {}
+
+
+def warm_up_web(warm_up: WebWarmUp) -> dict:
+    """Load what rendering the web app's cards needs, returning how many of each were loaded."""
+    proxygen.TEMPLATE_IMAGE_CACHE.maxsize = warm_up.template_image_cache_bytes
+    loaded = {}
+    for scale in warm_up.scales:
+        for name, n in proxygen.warm_up(scale, template_images=scale in warm_up.template_image_scales).items():
+            loaded[name] = loaded.get(name, 0) + n
+        card_img = proxygen.make_card_proxy(dict(warm_up.card), None, scale=scale)
+        for fmt in warm_up.formats:
+            encode(card_img, fmt, preset="web")
+    return loaded
+
+
+def web_worker_init(warm_up: Optional[WebWarmUp]):
+    """Warm up, unless this worker was forked from a fork server which already did."""
+    if warm_up is not None and not _web_state:
+        _web_state.update(warm_up_web(warm_up))
+
+
+def web_worker_state() -> dict:
+    """What this worker loaded when it started."""
+    return dict(_web_state)
+
+
+def render_web_card(
+    card_dict: dict,
+    bg_bytes: Optional[bytes],
+    fudge_factor: float,
+    make_alt: bool,
+    scale: float,
+    fmt: ImageFormat,
+    draft_background: bool = False,
+) -> bytes:
+    """A card from the web form drawn at scale over its uploaded background, if any, and encoded.
+    With draft_background, JPEG backgrounds are decoded at a reduced DCT scale, which is much faster."""
+    card_img = proxygen.make_card_proxy(card_dict, None, fudge_factor=fudge_factor, make_alt=make_alt, scale=scale)
+    if bg_bytes is not None:
+        if draft_background:
+            composited = proxygen.decode_background(BytesIO(bg_bytes), card_img.size)
+        else:
+            composited = Image.open(BytesIO(bg_bytes)).resize(card_img.size).convert("RGBA")
+        composited.paste(card_img, mask=card_img)
+        card_img = composited
+    return encode(card_img, fmt, preset="web")
+
+
+class PoolBusy(Exception):
+    """Every worker of a BoundedPool is busy and its queue is full."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Busy, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def _worker_pid() -> int:
+    # long enough that an idle worker can't take every job of BoundedPool.start's round
+    time.sleep(0.05)
+    return os.getpid()
+
+
+class BoundedPool:
+    """Worker processes started from a fork server, running initializer(*initargs) first. At
+    most processes jobs run at a time and queue_depth more wait; submitting to a full pool
+    raises PoolBusy rather than making the queue longer.
+
+    Forking the calling process instead could copy a lock some other thread holds into the
+    workers, where nothing would ever release it. The fork server is a fresh process with
+    this module, proxygen and the preload modules imported, so what those load is shared by
+    every worker, and ones replacing a worker that died start from it just as quickly."""
+
+    def __init__(self, processes: int, queue_depth: int, initializer=None, initargs=(), preload=()):
+        self.processes = processes
+        self.queue_depth = queue_depth
+        self.pid = os.getpid()  # the pool doesn't survive a fork, the child needs its own
+        self._initializer = initializer
+        self._initargs = initargs
+        self._preload = list(preload)
+        self._executor = self._new_executor()
+        self._lock = threading.Lock()
+        self.pending = 0  # jobs submitted and not done, running or queued
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.job_seconds = 0.0  # moving average of the time a job runs in a worker
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        context = multiprocessing.get_context("forkserver")
+        # imported from the working directory, the app's (the fork server doesn't get sys.path),
+        # and if that fails the workers import them themselves. Only the first pool's count, the
+        # fork server is started once per process.
+        context.set_forkserver_preload([__name__, *self._preload])
+        return ProcessPoolExecutor(
+            self.processes, mp_context=context, initializer=self._initializer, initargs=self._initargs
+        )
+
+    def start(self):
+        """Start every worker now rather than as jobs come in, and wait until all have run the initializer."""
+        pids = set()
+        try:
+            while len(pids) < self.processes:
+                # workers are started as jobs are submitted while none is idle, which is all of
+                # these the first time round, but a worker done warming up might take several
+                futures = [self._executor.submit(_worker_pid) for _ in range(self.processes)]
+                pids.update(future.result() for future in futures)
+        except BrokenProcessPool:
+            # e.g. the initializer failed: nothing to keep, the caller can try again with a new pool
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    def _done(self, future: Future):
+        with self._lock:
+            self.pending -= 1
+            if not future.cancelled() and future.exception() is None:
+                seconds = future.result()[0]
+                self.completed += 1
+                self.job_seconds = seconds if self.completed == 1 else 0.9 * self.job_seconds + 0.1 * seconds
+
+    def retry_after(self) -> int:
+        """Seconds until a full pool is likely to have room again."""
+        queued = max(1, self.pending - self.processes + 1)
+        return max(1, math.ceil(self.job_seconds * queued / self.processes))
+
+    def is_full(self) -> bool:
+        return self.pending >= self.processes + self.queue_depth
+
+    def submit(self, fn, *args) -> Future:
+        """Queue fn(*args) for a worker, or raise PoolBusy if the pool is full. Pass the future to result()."""
+        with self._lock:
+            if self.is_full():
+                self.rejected += 1
+                raise PoolBusy(self.retry_after())
+            self.pending += 1
+            executor = self._executor
+        try:
+            future = executor.submit(_timed, fn, *args)
+        except BrokenProcessPool:
+            # found out a worker died since the last job: nothing of this one is lost, so it can
+            # go to the new executor (which raises too if its workers can't start either)
+            executor = self._replace(executor)
+            try:
+                future = executor.submit(_timed, fn, *args)
+            except BrokenProcessPool:
+                with self._lock:
+                    self.pending -= 1
+                self._replace(executor)
+                raise
+        future.executor = executor
+        future.add_done_callback(self._done)
+        return future
+
+    def result(self, future: Future, timeout: Optional[float] = None):
+        """What the job of a submitted future returned. Raises TimeoutError if that takes more
+        than timeout seconds. A job which times out before it starts is dropped; one already
+        running keeps its worker until it's done."""
+        try:
+            return future.result(timeout)[1]
+        except FutureTimeoutError:
+            future.cancel()
+            with self._lock:
+                self.timed_out += 1
+            raise TimeoutError(f"No result in {timeout:g}s") from None
+        except BrokenProcessPool:
+            # a worker died, e.g. killed for running out of memory, which breaks the whole executor
+            self._replace(future.executor)
+            raise
+
+    def run(self, fn, *args, timeout: Optional[float] = None):
+        """fn(*args) in a worker, see submit() and result()."""
+        return self.result(self.submit(fn, *args), timeout)
+
+    def _replace(self, broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+        """Swap a broken executor for a new one (unless another thread already has), returning that."""
+        with self._lock:
+            if self._executor is not broken:
+                return self._executor
+            self._executor = self._new_executor()
+            replacement = self._executor
+        broken.shutdown(wait=False, cancel_futures=True)
+        return replacement
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "processes": self.processes,
+                "queue-depth": self.queue_depth,
+                "in-flight": min(self.pending, self.processes),
+                "queued": max(0, self.pending - self.processes),
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timed-out": self.timed_out,
+                "job-ms": round(1000 * self.job_seconds, 1),
+            }
@@ -0,0 +1,290 @@
+"""Card templates (assets/{type}.yaml), compiled once into immutable objects.
+
+Templates are shared between every card rendered by the process (and between threads),
+so nothing in here may be mutated after loading. Variants of a template (late-lunar
+resources, flip sides) are derived from the compiled template rather than by editing
+the YAML dict, and files are only re-read when their mtime changes."""
+import dataclasses
+import pathlib
+import threading
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Mapping, Optional
+
+RESOURCE_DIR = pathlib.Path(__file__).parent / "assets"
+
+# The factions templates are laid out for - everything else (apex, adam, sunny) is treated as neutral-runner
+TEMPLATE_FACTIONS = frozenset(
+    {
+        "anarch",
+        "criminal",
+        "haas-bioroid",
+        "jinteki",
+        "nbn",
+        "neutral-corp",
+        "neutral-runner",
+        "shaper",
+        "weyland-consortium",
+    }
+)
+
+# Top-level template keys which aren't graphical items
+NON_ITEM_KEYS = {"template_image", "atoms", "img_offset", "late_lunar_changes"}
+
+VARIANTS = ("late-lunar", "flip", "flipfront")
+
+
+def freeze(obj):
+    """Recursively turn YAML data into read-only mappings and tuples."""
+    if isinstance(obj, dict):
+        return MappingProxyType({k: freeze(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+def scale_prop(value, factor: float):
+    """Scale a (possibly faction-dependent) size or coordinate. Integers stay integers."""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, Mapping):
+        return MappingProxyType({k: scale_prop(v, factor) for k, v in value.items()})
+    if isinstance(value, tuple):
+        return tuple(scale_prop(v, factor) for v in value)
+    if isinstance(value, float):
+        return value * factor
+    return round(value * factor)
+
+
+def template_faction(faction: str) -> str:
+    return faction if faction in TEMPLATE_FACTIONS else "neutral-runner"
+
+
+@dataclass(frozen=True, slots=True)
+class Item:
+    """One graphical element of a template, with faction-dependent properties resolved up front."""
+
+    name: str
+    props: Mapping[str, Any]
+    by_faction: Mapping[str, Mapping[str, Any]]
+    font_path: Optional[str]
+    fontcolor: tuple[int, ...]
+    center: bool
+    rotation: Optional[int]
+    align_by_bottom_left_corner: bool
+    backdrop: Optional[Mapping[str, Any]]
+    eventual_indent: tuple[tuple[int, int], ...]
+
+    @classmethod
+    def compile(cls, name: str, props: Mapping[str, Any]) -> "Item":
+        by_faction = MappingProxyType(
+            {
+                faction: MappingProxyType(
+                    {
+                        propname: (
+                            prop[faction]
+                            if isinstance(prop, Mapping) and faction in prop
+                            else prop
+                        )
+                        for propname, prop in props.items()
+                    }
+                )
+                for faction in TEMPLATE_FACTIONS
+            }
+        )
+        return cls(
+            name=name,
+            props=props,
+            by_faction=by_faction,
+            font_path=str(RESOURCE_DIR / props["font"]) if "font" in props else None,
+            fontcolor=tuple(props.get("fontcolor", (0, 0, 0))),
+            center=bool(props.get("center")),
+            rotation=props.get("rotation"),
+            align_by_bottom_left_corner=bool(props.get("align_by_bottom_left_corner")),
+            backdrop=props.get("backdrop"),
+            eventual_indent=tuple(
+                (d["at_height"], d["indent"]) for d in props.get("eventual_indent", ())
+            ),
+        )
+
+    def scaled(self, factor: float) -> "Item":
+        props = dict(self.props)
+        for propname in ("loc", "fontsize", "width", "height"):
+            if propname in props:
+                props[propname] = scale_prop(props[propname], factor)
+        if self.backdrop:
+            props["backdrop"] = MappingProxyType(
+                {
+                    **self.backdrop,
+                    "width": scale_prop(self.backdrop["width"], factor),
+                    "offset": scale_prop(self.backdrop["offset"], factor),
+                }
+            )
+        if "eventual_indent" in props:
+            props["eventual_indent"] = tuple(
+                MappingProxyType({k: scale_prop(v, factor) for k, v in d.items()})
+                for d in props["eventual_indent"]
+            )
+        # fontcolor may have been changed by a variant, so keep it rather than recompiling it
+        return dataclasses.replace(
+            Item.compile(self.name, MappingProxyType(props)), fontcolor=self.fontcolor
+        )
+
+    def get(self, propname: str, default=None):
+        return self.props.get(propname, default)
+
+    def __getitem__(self, propname: str):
+        return self.props[propname]
+
+    def __contains__(self, propname: str) -> bool:
+        return propname in self.props
+
+    def lookup(self, faction: str, propname: str):
+        prop = self.by_faction[template_faction(faction)][propname]
+        if isinstance(prop, Mapping):
+            # missing some support here...
+            assert propname == "loc"
+            assert "below-of" in prop, f"Didn't understand position directive {prop}"
+            below_field = prop["below-of"]
+            assert below_field == "text"
+        return prop
+
+
+@dataclass(frozen=True, slots=True)
+class Template:
+    card_type: str
+    alt: bool
+    path: pathlib.Path
+    mtime_ns: int
+    variants: tuple[str, ...]
+    items: Mapping[str, Item]
+    template_image: Mapping[str, str]
+    atoms: Mapping[str, str]
+    img_offset: tuple[int, int]
+    late_lunar_changes: Mapping[str, Any]
+    image_suffix: str = ""
+    # Rendering size relative to the full 1720x2400 card. img_offset is left alone, since
+    # it is relative to the template image rather than the card.
+    scale: float = 1.0
+
+    @classmethod
+    def compile(cls, card_type: str, alt: bool, path: pathlib.Path, mtime_ns: int, raw: dict) -> "Template":
+        frozen = freeze(raw)
+        return cls(
+            card_type=card_type,
+            alt=alt,
+            path=path,
+            mtime_ns=mtime_ns,
+            variants=(),
+            items=MappingProxyType(
+                {k: Item.compile(k, v) for k, v in frozen.items() if k not in NON_ITEM_KEYS}
+            ),
+            template_image=frozen["template_image"],
+            atoms=frozen.get("atoms", MappingProxyType({})),
+            img_offset=tuple(frozen.get("img_offset", (0, 0))),
+            late_lunar_changes=frozen.get("late_lunar_changes", MappingProxyType({})),
+        )
+
+    def __getitem__(self, item: str) -> Item:
+        return self.items[item]
+
+    def __contains__(self, item: str) -> bool:
+        return item in self.items
+
+    def get(self, item: str, default=None) -> Optional[Item]:
+        return self.items.get(item, default)
+
+    def variant(self, name: str) -> "Template":
+        """Return this template with a variant applied. Derived templates are cached too."""
+        return self._cached(name, lambda: self._derive(name))
+
+    def scaled(self, factor: float) -> "Template":
+        """Return this template with all coordinates and font sizes scaled by factor,
+        for drawing directly at a smaller (or larger) output size. Apply variants first."""
+        if factor == 1.0:
+            return self
+        return self._cached(
+            ("scale", factor),
+            lambda: dataclasses.replace(
+                self,
+                items=MappingProxyType({k: v.scaled(factor) for k, v in self.items.items()}),
+                scale=self.scale * factor,
+            ),
+        )
+
+    def _cached(self, derivation, derive) -> "Template":
+        key = (self.path, self.mtime_ns, self.variants, self.scale, derivation)
+        with _lock:
+            if (template := _variant_cache.get(key)) is not None:
+                return template
+        template = derive()
+        with _lock:
+            return _variant_cache.setdefault(key, template)
+
+    def _derive(self, name: str) -> "Template":
+        assert name in VARIANTS, f"Unknown template variant {name}"
+        assert self.scale == 1.0, "Template variants must be applied before scaling"
+        variants = self.variants + (name,)
+        if name == "late-lunar":
+            items = dict(self.items)
+            template_image = self.template_image
+            for k, v in self.late_lunar_changes.items():
+                if k == "template_image":
+                    template_image = v
+                else:
+                    items[k] = Item.compile(k, v)
+            return dataclasses.replace(
+                self, variants=variants, items=MappingProxyType(items), template_image=template_image
+            )
+        if name == "flip":
+            # white text on black bg instead of opposite
+            items = dict(self.items)
+            items["title"] = dataclasses.replace(self.items["title"], fontcolor=(255, 255, 255))
+            return dataclasses.replace(
+                self, variants=variants, items=MappingProxyType(items), image_suffix="_flip"
+            )
+        return dataclasses.replace(self, variants=variants, image_suffix="_flipfront")
+
+    def template_image_relpath(self, faction: str, override: Optional[str] = None) -> str:
+        relpath = override or self.template_image[faction]
+        if self.image_suffix:
+            relpath = relpath.replace(".png", f"{self.image_suffix}.png")
+        return relpath
+
+
+_lock = threading.Lock()
+_template_cache: dict[pathlib.Path, Template] = {}
+_variant_cache: dict[tuple, Template] = {}
+
+
+def template_path(card_type: str, alt: bool) -> pathlib.Path:
+    return RESOURCE_DIR / (f"{card_type}_alt.yaml" if alt else f"{card_type}.yaml")
+
+
+def load_template(card_type: str, alt: bool = False) -> Template:
+    """Return the compiled template for a card type, re-reading the YAML only if it changed on disk."""
+    path = template_path(card_type, alt)
+    mtime_ns = path.stat().st_mtime_ns
+    with _lock:
+        template = _template_cache.get(path)
+        if template is not None and template.mtime_ns == mtime_ns:
+            return template
+
+    import yaml
+
+    with open(path) as f:
+        raw = yaml.safe_load(f)
+    template = Template.compile(card_type, alt, path, mtime_ns, raw)
+    with _lock:
+        _template_cache[path] = template
+        for key in [k for k in _variant_cache if k[0] == path and k[1] != mtime_ns]:
+            del _variant_cache[key]
+    return template
+
+
+def preload_templates() -> list[Template]:
+    """Compile every template in RESOURCE_DIR."""
+    return [
+        load_template(path.stem.removesuffix("_alt"), alt=path.stem.endswith("_alt"))
+        for path in sorted(RESOURCE_DIR.glob("*.yaml"))
+    ]
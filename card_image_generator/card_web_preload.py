@@ -0,0 +1,17 @@
+"""Warms up the web app's render pool fork server, see BoundedPool.
+
+The fork server imports this module before it forks any worker, so the templates, fonts,
+atoms and template images are loaded once, there. Workers fork from it warm and share what
+it loaded copy-on-write, rather than each loading it again (~25s and ~370MB apiece)."""
+import gc
+import os
+
+# proxygenserver would otherwise start warming up (and a render pool) in here as it's imported
+os.environ["CARDGEN_WARM_UP"] = "0"
+
+import proxygenserver
+from card_render_pool import web_worker_init
+
+web_worker_init(proxygenserver.WEB_WARM_UP)
+# keep the collector from writing to what was loaded, which would copy it into every worker
+gc.freeze()
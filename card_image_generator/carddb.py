@@ -0,0 +1,177 @@
+"""All the card data in an edn/ tree (cards, faces and set printings), loaded once into
+records indexed by id, code, title, set, faction and type.
+
+Reading the ~1700 EDN files takes a few hundred milliseconds, so the database is pickled
+into a snapshot inside the tree. Opening that takes milliseconds, and it is rebuilt
+whenever an EDN file is added, removed or changed (by mtime and size).
+
+    db = carddb.load()
+    db.card_for_code("01050").title
+"""
+import os
+import pickle
+from collections import defaultdict
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import card_edn
+
+EDN_DIR = Path(__file__).parent.parent / "edn"
+SNAPSHOT_NAME = ".carddb.snapshot"
+# Bump when the records change, so old snapshots get rebuilt
+SNAPSHOT_VERSION = 1
+SOURCE_DIRS = ("cards", "faces", "set-cards")
+
+
+class Printing(NamedTuple):
+    code: str
+    card_id: str
+    set_id: str
+    position: int
+    quantity: int
+    flavor: Optional[str]
+    illustrator: Optional[str]
+    data: dict  # the whole set-cards entry
+
+
+class Card(NamedTuple):
+    """A card or a face of one. data is what proxygen.load_card_edn returns for its file."""
+
+    id: str  # the file name, which is what everything goes by (a few files share an :id)
+    title: str
+    type: str
+    faction: str
+    side: str
+    path: str  # relative to the edn/ dir
+    data: dict
+    codes: tuple[str, ...]  # printings, oldest first
+    faces: tuple[str, ...]  # ids of its faces in edn/faces, front first
+
+
+class CardDB:
+    def __init__(self, cards: list[Card], faces: list[Card], printings: list[Printing]):
+        self.cards = {card.id: card for card in cards}
+        self.faces = {face.id: face for face in faces}
+        self.printings = {printing.code: printing for printing in printings}
+        self.by_title: dict[str, list[str]] = defaultdict(list)
+        self.by_set: dict[str, list[str]] = defaultdict(list)
+        self.by_faction: dict[str, list[str]] = defaultdict(list)
+        self.by_type: dict[str, list[str]] = defaultdict(list)
+        for card in cards:
+            self.by_title[card.title.lower()].append(card.id)
+            self.by_faction[card.faction].append(card.id)
+            self.by_type[card.type].append(card.id)
+        for printing in sorted(printings, key=lambda p: (p.set_id, p.position)):
+            self.by_set[printing.set_id].append(printing.code)
+        # plain dicts, so lookups of missing keys don't grow them
+        for name in ("by_title", "by_set", "by_faction", "by_type"):
+            setattr(self, name, dict(getattr(self, name)))
+
+    def card(self, card_id: str) -> Card:
+        return self.cards[card_id]
+
+    def card_for_code(self, code: str) -> Card:
+        return self.cards[self.printings[code].card_id]
+
+    def cards_titled(self, title: str) -> list[Card]:
+        return [self.cards[card_id] for card_id in self.by_title.get(title.lower(), ())]
+
+    def set_printings(self, set_id: str) -> list[Printing]:
+        return [self.printings[code] for code in self.by_set.get(set_id, ())]
+
+    def card_or_face(self, card_id: str) -> Card:
+        return self.cards.get(card_id) or self.faces[card_id]
+
+
+def _record(path: Path, edn_dir: Path, data: dict, codes=(), faces=()) -> Card:
+    return Card(
+        id=path.stem,
+        title=data["title"],
+        type=data["type"],
+        faction=data["faction"],
+        side=data["side"],
+        path=str(path.relative_to(edn_dir)),
+        data=data,
+        codes=tuple(codes),
+        faces=tuple(faces),
+    )
+
+
+def _face_sort_key(face_id: str):
+    return (not face_id.endswith("-front"), face_id)
+
+
+def build(edn_dir: Path = EDN_DIR) -> CardDB:
+    """Parse the whole tree."""
+    printings = []
+    for path in sorted((edn_dir / "set-cards").glob("*.edn")):
+        for data in card_edn.read(path):
+            printings.append(
+                Printing(
+                    code=data["code"],
+                    card_id=data["card-id"],
+                    set_id=data["set-id"],
+                    position=data["position"],
+                    quantity=data["quantity"],
+                    flavor=data.get("flavor"),
+                    illustrator=data.get("illustrator"),
+                    data=data,
+                )
+            )
+    codes = defaultdict(list)
+    for printing in sorted(printings, key=lambda p: p.code):
+        codes[printing.card_id].append(printing.code)
+
+    card_datas = {path: card_edn.read(path) for path in sorted((edn_dir / "cards").glob("*.edn"))}
+    face_paths = sorted((edn_dir / "faces").glob("*.edn"))
+    card_faces = defaultdict(list)
+    for path in face_paths:
+        # {card-id}-front, {card-id}-back and {card-id}-back-N. A few faces (biotech, sync) are named differently.
+        stem = path.stem
+        for marker in ("-front", "-back"):
+            if marker in stem:
+                card_faces[stem[: stem.rindex(marker)]].append(stem)
+    cards = [
+        _record(path, edn_dir, data, codes.get(path.stem, ()), sorted(card_faces.get(path.stem, ()), key=_face_sort_key))
+        for path, data in card_datas.items()
+    ]
+    faces = [_record(path, edn_dir, card_edn.read(path)) for path in face_paths]
+    return CardDB(cards, faces, printings)
+
+
+def source_stamps(edn_dir: Path = EDN_DIR) -> list[tuple[str, int, int]]:
+    stamps = []
+    for subdir in SOURCE_DIRS:
+        try:
+            entries = list(os.scandir(edn_dir / subdir))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.name.endswith(".edn"):
+                st = entry.stat()
+                stamps.append((f"{subdir}/{entry.name}", st.st_mtime_ns, st.st_size))
+    return sorted(stamps)
+
+
+def load(edn_dir: Path = EDN_DIR, snapshot_path: Optional[Path] = None) -> CardDB:
+    """Open the snapshot of edn_dir, rebuilding it if any of the EDN files changed."""
+    edn_dir = Path(edn_dir)
+    snapshot_path = Path(snapshot_path or edn_dir / SNAPSHOT_NAME)
+    stamps = source_stamps(edn_dir)
+    try:
+        with open(snapshot_path, "rb") as f:
+            version, snapshot_stamps, db = pickle.load(f)
+        if version == SNAPSHOT_VERSION and snapshot_stamps == stamps:
+            return db
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, AttributeError):
+        pass
+
+    db = build(edn_dir)
+    try:
+        tmp_path = snapshot_path.with_name(f"{snapshot_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump((SNAPSHOT_VERSION, stamps, db), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, snapshot_path)
+    except OSError:  # read-only checkout, just go without
+        pass
+    return db
@@ -0,0 +1,20 @@
+"""Serving proxygenserver. Cards are rendered in its own pool of worker processes, which
+fork from a fork server that loaded the render state, see proxygenserver.WARM_UP.
+
+    gunicorn -c gunicorn.conf.py proxygenserver:app
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+# cards are rendered in proxygenserver's pool of CARDGEN_RENDER_PROCESSES (one per core), so
+# one worker is enough, with a thread for every render it can run or queue and a few for the rest
+workers = int(os.environ.get("CARDGEN_WORKERS", "1"))
+threads = int(os.environ.get("CARDGEN_THREADS", 3 * (os.cpu_count() or 1) + 4))
+# The render pool's workers already share the render state copy-on-write, from its fork server.
+# Rendering in the request threads instead (CARDGEN_RENDER_PROCESSES=0) with CARDGEN_WARM_UP=1,
+# the app can be loaded before forking so that the workers share it the same way. Otherwise
+# the master would fork with the warm-up or render pool threads running. (Nor can gunicorn
+# workers share one fork server: only the process that started it can tell it's still alive.)
+preload_app = os.environ.get("CARDGEN_RENDER_PROCESSES") == "0" and os.environ.get("CARDGEN_WARM_UP") == "1"
+# a card with a big uploaded background can take a few seconds
+timeout = 60
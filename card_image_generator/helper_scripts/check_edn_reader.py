@@ -0,0 +1,82 @@
+"""Check that card_edn reads every file in an edn/ tree exactly like edn_format, and how much faster.
+
+edn_format's output is converted the way pyfy did (keywords to strings without the colon,
+vectors and lists to lists, maps to dicts) and compared to card_edn's, types included,
+so a 1 never passes for a 1.0 or a True. Then both parse the whole tree a few times.
+
+    python helper_scripts/check_edn_reader.py [edn dir] [--runs 3]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import edn_format
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import card_edn
+from proxygen import EDN_DIR
+
+
+def plain(obj):
+    """edn_format's output as plain Python values."""
+    if isinstance(obj, edn_format.Keyword):
+        return str(obj)[1:]
+    if isinstance(obj, (edn_format.ImmutableList, list, tuple)):
+        return [plain(item) for item in obj]
+    if isinstance(obj, (edn_format.ImmutableDict, dict)):
+        return {plain(k): plain(v) for k, v in obj.items()}
+    return obj
+
+
+def differences(expected, actual, where="") -> list[str]:
+    if type(expected) is not type(actual):
+        return [f"{where or 'top level'}: {expected!r} read as {actual!r}"]
+    if isinstance(expected, dict):
+        if expected.keys() != actual.keys():
+            return [f"{where or 'top level'}: keys {sorted(expected)} read as {sorted(actual)}"]
+        return [d for k in expected for d in differences(expected[k], actual[k], f"{where}:{k}")]
+    if isinstance(expected, list):
+        if len(expected) != len(actual):
+            return [f"{where or 'top level'}: {len(expected)} items read as {len(actual)}"]
+        return [d for i, (e, a) in enumerate(zip(expected, actual)) for d in differences(e, a, f"{where}[{i}]")]
+    return [] if expected == actual else [f"{where or 'top level'}: {expected!r} read as {actual!r}"]
+
+
+def time_reading(texts: list[str], parse, runs: int) -> float:
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        for text in texts:
+            parse(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("edn_dir", nargs="?", default=EDN_DIR, type=Path)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    paths = sorted(args.edn_dir.rglob("*.edn"))
+    texts = [path.read_text(encoding="utf-8") for path in paths]
+    failed = 0
+    for path, text in zip(paths, texts):
+        try:
+            problems = differences(plain(edn_format.loads(text)), card_edn.loads(text))
+        except card_edn.EDNError as e:
+            problems = [str(e)]
+        if problems:
+            failed += 1
+            print(f"{path.relative_to(args.edn_dir)}: {'; '.join(problems[:3])}")
+    print(f"{len(paths) - failed}/{len(paths)} files read identically")
+
+    slow = time_reading(texts, edn_format.loads, args.runs)
+    fast = time_reading(texts, card_edn.loads, args.runs)
+    print(f"edn_format: {slow:.2f}s, card_edn: {fast:.3f}s ({slow / fast:.0f}x faster)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,59 @@
+"""Check that importing proxygen stays within its startup budget.
+
+Rendering a single card from the command line shouldn't pay for things it doesn't use,
+so heavy dependencies (yaml, argparse) are imported where they're needed.
+This measures `import proxygen` with `python -X importtime`, taking the best of a few
+runs, and lists the slowest modules when over budget.
+
+    python helper_scripts/check_import_time.py [--budget-ms 120]
+"""
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+CARD_IMAGE_GENERATOR_DIR = Path(__file__).resolve().parent.parent
+# About 90ms on a laptop, most of it PIL
+IMPORT_TIME_BUDGET_MS = 120
+
+
+def measure_import(module: str) -> list[tuple[str, int, int]]:
+    """(module, self us, cumulative us) for every module imported by `import module`."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=CARD_IMAGE_GENERATOR_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        timings.append((name.strip(), int(self_us), int(cumulative_us)))
+    return timings
+
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="proxygen")
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_TIME_BUDGET_MS)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    # the first run may be writing .pyc files
+    runs = [measure_import(args.module) for _ in range(args.runs + 1)][1:]
+    best = min(runs, key=lambda timings: timings[-1][2])
+    total_ms = best[-1][2] / 1000
+    print(f"import {args.module}: {total_ms:.1f}ms (budget {args.budget_ms:.0f}ms)")
+    if total_ms <= args.budget_ms:
+        return 0
+    print("Slowest modules (self time):")
+    for name, self_us, _ in sorted(best, key=lambda t: -t[1])[:10]:
+        print(f"  {self_us / 1000:7.1f}ms  {name}")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,18 +1,20 @@
 import functools
 import itertools
 import json
-import subprocess
+import sys
 import tempfile
 from pathlib import Path
 from pprint import pprint
 
-import edn_format
 import matplotlib
 import randimage
 import yaml
 import pickle
-from proxygen_utils import card_dict_from_edn_text, dict_pyfy, pyfy
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import carddb
+from proxygen import render_card
+from card_render_cache import RenderCache
 
 
 # Given a set, iterate over it and find all the card codes. For each card code, first attempt to generate it. If it works, the card was an old card, so do nothing. If not, check the faces dir - if there is cardid-front/back there, there are two faces, and generate each one. Otherwise, check a given art dir and use the image there if possible, otherwise just use black (someday, autogenerate?)
@@ -26,10 +28,11 @@ EDN_DIR = NR_DATA_DIR / "edn/cards/"
 FACES_DIR = NR_DATA_DIR / "edn/faces/"
 BG_IMG_DIR = OLD_NR_DATA_DIR / "new_cards/pretexts/"
 AUTOGEN_BG_IMG_PICKLE = OLD_NR_DATA_DIR / "new_cards/pretexts/generated.pkl"
-PROXYGEN_PATH = NR_DATA_DIR / "card_image_generator/proxygen.py"
 
-SET_EDN_PATH = NR_DATA_DIR / "edn/set-cards/new-normal.edn"
+SET_ID = "new-normal"
 OUTPUT_PATH = NR_DATA_DIR / "scratch/limit-cycle-1/251230/"
+# Cards which haven't changed since the last run are copied from here instead of re-rendered
+RENDER_CACHE = RenderCache(NR_DATA_DIR / "scratch/render_cache/")
 
 OUTPUT_PATH.mkdir(exist_ok=True)
 try:
@@ -46,13 +49,8 @@ def make_random_image(card_id):
         autogen_imgs[card_id] = randimage.get_random_image((344, 480))
     return autogen_imgs[card_id]
 
-with open(SET_EDN_PATH) as f:
-    edn_list = edn_format.edn_parse.parse(f.read())
-    card_dict_list = [dict_pyfy(d) for d in edn_list]
-
-
-for card_dict in card_dict_list:
-    card_code, card_id = card_dict["code"], card_dict["card-id"]
+for printing in carddb.load(NR_DATA_DIR / "edn").set_printings(SET_ID):
+    card_code, card_id = printing.code, printing.card_id
     special_cards_list = {
         "53031": {"consolidation": "53031"},
         "51015": {"the-horde-front": "51015_front", "the-horde-back": "51015_back"},
@@ -66,17 +64,10 @@ for card_dict in card_dict_list:
         continue
     try:
         # If it's an existing card, background is autodected
-        subprocess.check_output(
-            [
-                "python",
-                PROXYGEN_PATH,
-                EDN_DIR / f"{card_id}.edn",
-                OUTPUT_PATH / f"{card_code}.jpg",
-            ]
-        )
+        render_card(EDN_DIR / f"{card_id}.edn", OUTPUT_PATH / f"{card_code}.jpg", cache=RENDER_CACHE)
         print(f"Generated rebooted card {card_code} ({card_id})!")
 
-    except subprocess.CalledProcessError:
+    except Exception:
         # Otherwise, we make a random one - just check if there are two faces first
 
         if (FACES_DIR / f"{card_id}-front.edn").exists():
@@ -103,10 +94,8 @@ for card_dict in card_dict_list:
                     matplotlib.image.imsave(tmpf.name, make_random_image(str(edn_path)))
                     bg_path = tmpf.name
                 try:
-                    subprocess.check_output(
-                        ["python", PROXYGEN_PATH, edn_path, proxy_path, bg_path]
-                    )
-                except subprocess.CalledProcessError as e:
+                    render_card(edn_path, proxy_path, background_img_path=bg_path, cache=RENDER_CACHE)
+                except Exception as e:
                     print(e)
 
 with open(AUTOGEN_BG_IMG_PICKLE, 'wb') as f:
@@ -1,27 +1,20 @@
 import json
-
-import glob
+import sys
 from pathlib import Path
 
-import edn_format
 import yaml
 from collections import defaultdict
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import carddb
+
+db = carddb.load(Path("/home/karlerik/hobby/netrunner-data/edn/"))
 code_dict = defaultdict(list)
 title_dict = dict()
 
-edn_kw = edn_format.Keyword
-for path in map(
-    Path, glob.glob("/home/karlerik/hobby/netrunner-data/edn/set-cards/*.edn")
-):
-    with open(path) as f:
-        cards = edn_format.edn_parse.parse_all(f.read())[0]
-        for card in cards:
-            card_id = card[edn_kw("card-id")]
-            code_dict[card_id].append(card[edn_kw("code")])
-
-            card_data_path = Path("/home/karlerik/hobby/netrunner-data/edn/cards/") / f'{card_id}.edn'
-            card_data = edn_format.edn_parse.parse_all(card_data_path.read_bytes())[0]
-            title_dict[card_id] = card_data[edn_kw("title")]
+for printing in db.printings.values():
+    code_dict[printing.card_id].append(printing.code)
+    title_dict[printing.card_id] = db.card(printing.card_id).title
 
 
 multi_print_dict = {}
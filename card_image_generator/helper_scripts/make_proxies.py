@@ -1,11 +1,21 @@
+import functools
 import itertools
 import json
+import sys
 import yaml
 import subprocess
 from pathlib import Path
 from multiprocessing import Pool
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from proxygen import render_card
+from card_render_cache import RenderCache
+import card_build_plan
+from card_render_pool import MAX_TASKS_PER_WORKER, preload
+
 BLEED_SCRIPT = '/home/karlerik/hobby/proxynexus/misc/border_generator_cv.py'
+# Cards which haven't changed since the last run are copied from here instead of re-rendered
+RENDER_CACHE = RenderCache(Path(__file__).resolve().parent / ".render_cache")
 
 POST_MIDLUNAR_RESOURCE_CARD_CODES: list[str] = [
     '06080',
@@ -196,6 +206,8 @@ outdir_db_changed = outdir_root / "changed_deckbuilding"
 outdir_changed = outdir_root / "changed"
 BLEED = "bleeds"
 UNBLEED = "nonbleeds"
+# What every proxy was made from, so reruns only remake the ones affected by a change
+MANIFEST_PATH = outdir_root / "manifest.json"
 
 
 def should_print(card_code: str):
@@ -224,10 +236,11 @@ def should_print(card_code: str):
     # return 9028 < int(card_code) < 9053
 
 
-def card_code_worker(card_code: tuple[str, dict]):
+def card_code_worker(card_code: tuple[str, dict], up_to_date: frozenset[str] = frozenset()):
+    """Returns (proxy path, manifest entry) for every proxy made, and (proxy path, error) for failures."""
     code, data = card_code
     if not should_print(code):
-        return
+        return [], []
 
     outdir = outdir_changed if data["ingame_change"] else outdir_db_changed if data["change"] else outdir_unchanged
 
@@ -244,10 +257,18 @@ def card_code_worker(card_code: tuple[str, dict]):
         proxy_paths = [str((outdir / UNBLEED) / f"{code}.png")]
         edn_paths = [f"../edn/cards/{card}.edn"]
 
+    made, failures = [], []
     for edn_path, proxy_path in zip(edn_paths, proxy_paths):
+        if str(Path(proxy_path).resolve()) in up_to_date:
+            continue
         print(f'Generating {code=} ({card=}) to {outdir}...')
-        subprocess.check_output(["python", "proxygen.py", edn_path, proxy_path])
-        subprocess.check_output(["python", BLEED_SCRIPT, proxy_path, '-o', str(outdir / BLEED)])
+        try:
+            render_card(edn_path, proxy_path, cache=RENDER_CACHE)
+            subprocess.check_output(["python", BLEED_SCRIPT, proxy_path, '-o', str(outdir / BLEED)])
+            made.append((str(Path(proxy_path).resolve()), card_build_plan.make_entry(edn_path)))
+        except Exception as e:
+            failures.append((proxy_path, f"{type(e).__name__}: {e}"))
+    return made, failures
 
 
 if __name__ == '__main__':
@@ -269,5 +290,24 @@ if __name__ == '__main__':
 
     all_things = sorted(card_change_dict.items(),
                         key=lambda tpl: (-int(tpl[1]['ingame_change']), tpl[1]['change'] is None))
-    with Pool(8) as p:
-        p.map(card_code_worker, all_things)
+    # Pass a git range (e.g. HEAD~1..HEAD) to only look at files changed in it
+    manifest = card_build_plan.load_manifest(MANIFEST_PATH)
+    changed = card_build_plan.git_changed_files(sys.argv[1]) if len(sys.argv) > 1 else None
+    plan = card_build_plan.plan_rebuild(manifest, changed)
+    card_build_plan.print_plan(plan)
+
+    # workers load the templates, fonts and card data once rather than per card
+    failures = []
+    try:
+        with Pool(8, initializer=preload, maxtasksperchild=MAX_TASKS_PER_WORKER) as p:
+            worker = functools.partial(card_code_worker, up_to_date=frozenset(plan.skipped))
+            for made, failed in p.imap_unordered(worker, all_things, chunksize=4):
+                for proxy_path, entry in made:
+                    manifest["outputs"][proxy_path] = entry
+                failures += failed
+    finally:
+        # keep what was made even if the pool dies, failed outputs keep their old entries
+        card_build_plan.save_manifest(MANIFEST_PATH, manifest)
+    for proxy_path, error in failures:
+        print(f"{proxy_path}: FAILED {error}")
+    sys.exit(1 if failures else 0)
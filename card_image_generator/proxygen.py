@@ -1,15 +1,28 @@
+import functools
+import hashlib
 import json
+import os
 import pathlib
 import re
 import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from pathlib import Path
 from typing import NamedTuple, Optional
 
-import edn_format
-import yaml
 from PIL import Image, ImageDraw, ImageFont
 
+import card_edn
+import carddb
+from card_profile import Profile, activated, call_in, count, span
+from card_encoders import PRESETS, ImageFormat, encode, encoder_pool, format_for_path, save_image
+from card_metadata import CardMetadata, MetadataSources, load_metadata, require
+from card_render_cache import RenderCache, content_key, file_digest
+from card_templates import RESOURCE_DIR, TEMPLATE_FACTIONS, Template, load_template, preload_templates
+
 # flavor_dict = yaml.load(Path('/home/karlerik/hobby/netrunner-data/flavor_dict.yaml').read_text())
 
 # Haven't bothered making a template for literally just 1 card
@@ -36,6 +49,8 @@ SPLIT_AGENDA_RELPATHS = {
     "flood-the-zone": "odd_cards/split_agendas/nbn_weyland_agenda.png",
 }
 LONG_BREAK = 1.7
+# Size of a rendered card at scale 1.0. Template coordinates are relative to this.
+CARD_SIZE = (1720, 2400)
 SUBROUTINE_CHAR = chr(129)
 REBOOT_INDICATOR = "\u0180" + chr(0x80)
 
@@ -107,74 +122,232 @@ CYCLE_SYMS = {                  # Maps each cycle code (01 = core, 10 = data & d
 }
 
 
-RESOURCE_DIR = pathlib.Path(__file__).parent / "assets"
+class LRUCache:
+    """Small thread-safe LRU with hit/miss/eviction counters, used for fonts and text layouts.
+
+    If weigh is given, maxsize bounds the total weigh(value) of the entries rather than their number."""
+
+    def __init__(self, maxsize: int, weigh=None):
+        self.maxsize = maxsize
+        self.weigh = weigh or (lambda value: 1)
+        self.weight = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, factory):
+        """Return the cached value for key, calling factory() to create it if needed."""
+        with self._lock:
+            if (value := self._entries.get(key)) is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = factory()
+        with self._lock:
+            if (old := self._entries.pop(key, None)) is not None:
+                self.weight -= self.weigh(old)
+            self._entries[key] = value
+            self.weight += self.weigh(value)
+            while self.weight > self.maxsize and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.weight -= self.weigh(evicted)
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "weight": self.weight,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# Text fitting tries lots of sizes of the same couple of fonts, and FreeType
+# parsing the font file every time is far from free.
+FONT_CACHE = LRUCache(maxsize=256)
+# (text, font path, font size, width, is_ice_text) -> (lines, total line height)
+LAYOUT_CACHE = LRUCache(maxsize=8192)
+
+
+def load_font(font_path, size: int) -> ImageFont.FreeTypeFont:
+    font_path = str(font_path)
 
-try:
-    CHANGED_CARD_CODES = set(json.loads(Path("changed_card_codes.json").read_text()))
-except FileNotFoundError:
-    CHANGED_CARD_CODES = []
+    def load():
+        count("font-loads")
+        return ImageFont.truetype(font_path, size=size)
 
-def lookup_font_props(template_dict, card_faction, item):
-    font_path = str(RESOURCE_DIR / template_dict[item]["font"])
+    return FONT_CACHE.get((font_path, size), load)
+
+
+def lookup_font_props(template: Template, card_faction, item):
+    font_path = template[item].font_path
     font_size = factionwise_template_lookup(
-        template_dict, card_faction, item, "fontsize"
+        template, card_faction, item, "fontsize"
     )
     # TODO: add support for default to factionwise_template_lookup so this can be faciton-based
-    # or maybe make the template dict a separate class...
-    font_color = tuple(template_dict[item].get("fontcolor", (0, 0, 0)))
+    font_color = template[item].fontcolor
 
     return font_path, font_size, font_color
 
 
-def get_text_dimensions(text_string, font):
-    text_string = text_string.replace(chr(156), SUBROUTINE_CHAR)
-    text_string = re.sub(r"<ral(\d{2})>", "", text_string)
-    text_string = re.sub("<br>", "", text_string)
+class TextMeasurer:
+    """Measures text the way the card layout expects, memoized per (normalized text, font).
+
+    Everything measured goes through here: every line drawn, the line breaking near its
+    threshold, the "X" line height estimates and every template item."""
+
+    RAL_RE = re.compile(r"<ral(\d{2})>")
+    BR_RE = re.compile("<br>")
+
+    def __init__(self, maxsize: int = 32768):
+        self._cache = LRUCache(maxsize=maxsize)
 
-    bbox = font.getbbox(text_string)
-    ascent, descent = font.getmetrics()
+    def normalize(self, text_string: str) -> str:
+        """Strip the markup which isn't drawn, and measure chr(156) as the subroutine symbol."""
+        text_string = text_string.replace(chr(156), SUBROUTINE_CHAR)
+        if "<" not in text_string:
+            return text_string
+        text_string = self.RAL_RE.sub("", text_string)
+        return self.BR_RE.sub("", text_string)
 
-    width = bbox[2] - bbox[0]
-    height = ascent + descent
+    def dimensions(self, text_string: str, font) -> tuple[int, int]:
+        """Width and height of the inked part of the text."""
+        text_string = self.normalize(text_string)
+        return self._cache.get(
+            ("ink", text_string, font.path, font.size),
+            lambda: self._ink_dimensions(text_string, font),
+        )
+
+    def metric_dimensions(self, text_string: str, font) -> tuple[int, int]:
+        """Advance width, and ascent + descent for the height, so the baseline is always in the same place."""
+        text_string = self.normalize(text_string)
+        return self._cache.get(
+            ("metric", text_string, font.path, font.size),
+            lambda: self._metric_dimensions(text_string, font),
+        )
+
+    @staticmethod
+    def _ink_dimensions(text_string: str, font) -> tuple[int, int]:
+        # very much like draw.textsize, but see  https://stackoverflow.com/a/46220683/9263761
+        if (bbox := font.getmask(text_string).getbbox()) is None:
+            # Pillow ≥10: getsize() removed → use getbbox()
+            bbox = font.getbbox(text_string)
+        # bbox = hori_offset, vert_offset, text_rect_width, text_rect_heihgt
+        return bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+    @staticmethod
+    def _metric_dimensions(text_string: str, font) -> tuple[int, int]:
+        # Width: still measure glyphs
+        bbox = font.getbbox(text_string)
+        # Height: baseline-safe, old Pillow behavior
+        ascent, descent = font.getmetrics()
+        return bbox[2] - bbox[0], ascent + descent
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> dict[str, int]:
+        return self._cache.stats()
+
+
+TEXT_MEASURER = TextMeasurer()
+
+
+def get_text_dimensions(text_string, font):
+    return TEXT_MEASURER.dimensions(text_string, font)
 
-    return width, height
 
 def new_get_text_dimensions(text_string, font):
     # TODO: I want to port the generator to this to avoid clipping on ice strength, but this would break some other stuff, so for now I am not using it everywhere.
-    text_string = text_string.replace(chr(156), SUBROUTINE_CHAR)
-    text_string = re.sub(r"<ral(\d{2})>", "", text_string)
-    text_string = re.sub("<br>", "", text_string)
+    return TEXT_MEASURER.metric_dimensions(text_string, font)
 
-    # Width: still measure glyphs
-    bbox = font.getbbox(text_string)
-    width = bbox[2] - bbox[0]
 
-    # Height: baseline-safe, old Pillow behavior
-    ascent, descent = font.getmetrics()
-    height = ascent + descent
+WORD_SPLIT_RE = re.compile(r"(\s+)")
+LONG_BREAK_RE = re.compile(r"(\s)*\n+(\s)*")
+# Note: this is contingent on get_text_dimensions helping out, for baffling reasons
+SUBROUTINE_WIDTH_INDENT = chr(156) + " "
+# Right-aligned quote lines start with <ralXX>, XX being how many spaces to leave on the right
+QUOTE_LINE_RE = re.compile(r"^\s*<ral(\d{2})>\s*")
+# Width estimates closer than this (in pixels) to the text width get measured properly
+LINE_WIDTH_ESTIMATE_MARGIN = 2
 
-    return width, height
+# (font path, font size, token) -> TokenMetrics
+TOKEN_METRICS_CACHE = LRUCache(maxsize=65536)
+# (font path, font size, char, char) -> kerning
+KERNING_CACHE = LRUCache(maxsize=65536)
 
-def get_text_dimensions(text_string, font):
-    # very much like draw.textsize, but see  https://stackoverflow.com/a/46220683/9263761
-    # ascent, descent = font.getmetrics() # if needed
-    text_string = text_string.replace(chr(156), SUBROUTINE_CHAR)
-    text_string = re.sub(r"<ral(\d{2})>", "", text_string)
-    text_string = re.sub("<br>", "", text_string)
 
-    if (bbox := font.getmask(text_string).getbbox()) is not None:
-        # bbox = hori_offset, vert_offset, text_rect_width, text_rect_heihgt
+class TokenMetrics(NamedTuple):
+    text: str  # as measured by get_text_dimensions, i.e. without <ralXX>/<br>
+    advance: float
+    ink: Optional[tuple[int, int]]  # horizontal ink extent relative to the pen position
 
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]  # + descent
 
-        return (text_width, text_height)
-    else:
-        # Pillow ≥10: getsize() removed → use getbbox()
-        bbox = font.getbbox(text_string)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-        return (text_width, text_height)
+class LineExtent(NamedTuple):
+    """Where the ink of a partial line starts and ends, and where the next word goes."""
+
+    pen: float = 0.0
+    left: Optional[float] = None
+    right: Optional[float] = None
+    last_char: str = ""
+
+    @property
+    def width(self) -> Optional[float]:
+        return None if self.left is None else self.right - self.left
+
+
+def token_metrics(token: str, font) -> TokenMetrics:
+    def compute():
+        text = TEXT_MEASURER.normalize(token)
+        mask, (offset_x, _) = font.getmask2(text)
+        bbox = mask.getbbox()
+        ink = None if bbox is None else (offset_x + bbox[0], offset_x + bbox[2])
+        return TokenMetrics(text, font.getlength(text), ink)
+
+    return TOKEN_METRICS_CACHE.get((font.path, font.size, token), compute)
+
+
+def kerning(a: str, b: str, font) -> float:
+    return KERNING_CACHE.get(
+        (font.path, font.size, a, b),
+        lambda: font.getlength(a + b) - font.getlength(a) - font.getlength(b),
+    )
+
+
+def extend_line(extent: LineExtent, token: str, font) -> LineExtent:
+    """Place token after the line so far, using cached per-token metrics and pairwise kerning."""
+    metrics = token_metrics(token, font)
+    if not metrics.text:
+        return extent
+    pen = extent.pen
+    if extent.last_char:
+        pen += kerning(extent.last_char, metrics.text[0], font)
+    left, right = extent.left, extent.right
+    if metrics.ink is not None:
+        ink_left, ink_right = pen + metrics.ink[0], pen + metrics.ink[1]
+        left = ink_left if left is None else min(left, ink_left)
+        right = ink_right if right is None else max(right, ink_right)
+    return LineExtent(pen + metrics.advance, left, right, metrics.text[-1])
+
+
+def line_fits(line: str, extent: LineExtent, font, text_width: int) -> bool:
+    """Whether get_text_dimensions(line)[0] < text_width, only measuring line when the estimate is close."""
+    estimate = extent.width
+    if estimate is None or abs(estimate - text_width) <= LINE_WIDTH_ESTIMATE_MARGIN:
+        return get_text_dimensions(line, font)[0] < text_width
+    return estimate < text_width
 
 
 def determine_line_breaks(
@@ -182,35 +355,43 @@ def determine_line_breaks(
 ) -> tuple[list[str], int]:
     """Given some text and a max width, determine how large it will be, and where to break.
     Return the text as broken lines, and the total line height (including line spacing).
-    Some line breaks are long and counted as LONG_BREAK length, and are indicated by lines ending in \n."""
+    Some line breaks are long and counted as LONG_BREAK length, and are indicated by lines ending in \n.
 
-    words = re.split(r"(\s+)", text)
+    Word widths are measured once per font and added up (see extend_line), so lines
+    are only rasterized to measure them when they're close to text_width."""
+
+    words = WORD_SPLIT_RE.split(text)
+    num_words = len(words)
+    i = 0
 
     lines = []
-    # Note: this is contingent on get_text_dimensions helping out, for baffling reasons
-    SUBROUTINE_WIDTH_INDENT = chr(156) + " "
     have_seen_subroutine_symbol = False
-    while words:
-        line = ""  # words.pop(0)
+    while i < num_words:
+        line = ""
+        extent = LineExtent()
         if is_ice_text and have_seen_subroutine_symbol and not lines[-1].endswith('\n'):
             line = SUBROUTINE_WIDTH_INDENT + line
-        while words and (
-            (not line) or get_text_dimensions(line + words[0], font)[0] < text_width
-        ):
-            w = words.pop(0)
+            extent = extend_line(extent, SUBROUTINE_WIDTH_INDENT, font)
+        while i < num_words:
+            w = words[i]
+            next_extent = extend_line(extent, w, font)
+            if line and not line_fits(line + w, next_extent, font, text_width):
+                break
+            i += 1
             if w.startswith(SUBROUTINE_CHAR):
                 have_seen_subroutine_symbol = True
             if w == "<br>":
                 # \r is a space character, so will likely have surrounding spaces
                 break
-            if re.match("(\s)*\n+(\s)*", w):
+            if LONG_BREAK_RE.match(w):
                 line += "\n"  # now lines end in '\n' if they should break long instead
                 break
             line += w
+            extent = next_extent
 
-        while words and words[0] == "\n":
+        while i < num_words and words[i] == "\n":
             # the first word in each line is never checked for being a newline - two newlines do nothing (yet)
-            words.pop(0)
+            i += 1
             line += "\n"
         lines.append(line)
 
@@ -219,23 +400,177 @@ def determine_line_breaks(
     return lines, total_line_height
 
 
+class FitResult(NamedTuple):
+    text_font_size: int
+    flavor_font_size: int
+    text_lines: list[str]
+    text_height: int
+    flavor_lines: list[str]
+    flavor_height: int
+    layout_passes: int  # line breaking actually done
+    layout_probes: int  # layouts asked for, including memoized ones
+
+
+def layout_text(text: str, font_path: str, font_size: int, text_width: int, is_ice_text: bool) -> tuple[list[str], int]:
+    """Memoized determine_line_breaks. Returns a fresh list, the cached lines are never handed out."""
+    def compute():
+        lines, height = determine_line_breaks(
+            text, load_font(font_path, font_size), None, text_width, is_ice_text
+        )
+        return tuple(lines), height
+
+    lines, height = LAYOUT_CACHE.get((text, font_path, font_size, text_width, is_ice_text), compute)
+    return list(lines), height
+
+
+def largest_fitting(lo: int, hi: int, fits) -> Optional[int]:
+    """Largest size in [lo, hi] for which fits(size), or None if nothing fits. Assumes fits is monotone.
+
+    Most cards fit at (or just below) the template size, so this gallops down from hi
+    with doubling steps, and then bisects the last step."""
+    step = 1
+    size = hi
+    while not fits(size):
+        too_large = size
+        if size == lo:
+            return None
+        size = max(lo, size - step)
+        step *= 2
+    if size == hi:
+        return size
+
+    while too_large - size > 1:
+        mid = (size + too_large) // 2
+        if fits(mid):
+            size = mid
+        else:
+            too_large = mid
+    return size
+
+
+def fit_text_sizes(
+    card_text: str,
+    text_font_path: str,
+    text_font_size: int,
+    flavor_text: str,
+    flavor_font_path: str,
+    flavor_font_size: int,
+    textwidth: int,
+    textheight: int,
+    extra_inter_spacing: int,
+    is_ice_text: bool,
+    min_text_font_size: int = 16,
+    min_flavor_font_size: int = 11,
+) -> FitResult:
+    """Pick the largest font sizes for which text and flavor text fit in the text box.
+
+    Flavor text is shrunk first, keeping the text at full size. If even the smallest
+    flavor text doesn't fit, the text is shrunk too, keeping the smallest flavor size.
+    Cards without flavor text always use the full text size. This is what stepping down
+    one point at a time used to pick, but since fit is monotone in font size it searches
+    with largest_fitting instead."""
+    probes = 0
+    misses_before = LAYOUT_CACHE.misses
+
+    def text_layout(size):
+        nonlocal probes
+        probes += 1
+        return layout_text(card_text, text_font_path, size, textwidth, is_ice_text)
+
+    def flavor_layout(size):
+        nonlocal probes
+        probes += 1
+        return layout_text(flavor_text, flavor_font_path, size, textwidth, False)
+
+    def fits(text_size, flavor_size):
+        # insist on some inter-text spacing
+        free_vert_space = textheight - (
+            flavor_layout(flavor_size)[1] + text_layout(text_size)[1] + extra_inter_spacing
+        )
+        return free_vert_space > 0
+
+    text_size, flavor_size = text_font_size, flavor_font_size
+    if flavor_text:
+        flavor_size = None
+        if flavor_font_size >= min_flavor_font_size:
+            flavor_size = largest_fitting(
+                min_flavor_font_size, flavor_font_size, lambda size: fits(text_font_size, size)
+            )
+        if flavor_size is None:
+            # no flavor text is small enough
+            flavor_size = min_flavor_font_size
+            text_size = None
+            if text_font_size > min_text_font_size:
+                text_size = largest_fitting(
+                    min_text_font_size, text_font_size - 1, lambda size: fits(size, flavor_size)
+                )
+            if text_size is None:
+                text_size = min_text_font_size
+
+    text_lines, text_height = text_layout(text_size)
+    flavor_lines, flavor_height = flavor_layout(flavor_size) if flavor_text else ([], 0)
+    return FitResult(
+        text_size,
+        flavor_size,
+        text_lines,
+        text_height,
+        flavor_lines,
+        flavor_height,
+        # not exact if another thread is laying out concurrently, but good enough for reporting
+        LAYOUT_CACHE.misses - misses_before,
+        probes,
+    )
+
+
+class TextboxLine(NamedTuple):
+    xy: tuple[float, float]
+    text: str
+    font: ImageFont.FreeTypeFont
+    fill: tuple[int, ...]
+
+
+class TextboxLayout(NamedTuple):
+    """Where every line of text and flavor text goes, in the coordinates of the text box image."""
+
+    size: tuple[int, int]  # of the text box image
+    top_pad: int
+    fit: FitResult
+    free_vert_space: float
+    lines: list[TextboxLine]
+    bottom: float  # of the last line, including top_pad
+
+
 def special_text_flavortext_handling(
-    template_dict, card_dict, fontsize_fudge_factor: float = 1.0
+    template: Template, card_dict, fontsize_fudge_factor: float = 1.0, stats: Optional[dict] = None
 ) -> tuple[Image, int]:
     """Size text/flavortext is interdependent, so must be done concurrently. Pretty messy.
     Includes a vertical buffer on the top of the image, whose size is returned."""
+    with span("layout"):
+        layout = layout_textbox(template, card_dict, fontsize_fudge_factor, stats=stats)
+    with span("draw"):
+        retimg = Image.new("RGBA", layout.size, color=(0, 0, 0, 0))
+        draw = ImageDraw.Draw(retimg)
+        for line in layout.lines:
+            draw.text(line.xy, line.text, font=line.font, fill=line.fill, anchor="la")
+    return retimg, layout.top_pad
+
+
+def layout_textbox(
+    template: Template, card_dict, fontsize_fudge_factor: float = 1.0, stats: Optional[dict] = None
+) -> TextboxLayout:
+    """Fit the text and flavor text, and work out where each line goes, without drawing anything."""
 
     long_break_factor = card_dict.get("long-break-factor", LONG_BREAK)
     card_faction = card_dict["faction"]
     text_font_path, text_font_size, text_font_color = lookup_font_props(
-        template_dict, card_faction, "text"
+        template, card_faction, "text"
     )
     flavor_font_path, flavor_font_size, flavor_font_color = lookup_font_props(
-        template_dict, card_faction, "flavor"
+        template, card_faction, "flavor"
     )
 
     textwidth, textheight = [
-        factionwise_template_lookup(template_dict, card_faction, "text", s)
+        factionwise_template_lookup(template, card_faction, "text", s)
         for s in ["width", "height"]
     ]
 
@@ -251,24 +586,20 @@ def special_text_flavortext_handling(
         flavor_text = parse_text(flavor_text, font_offsets=FLAVOR_OFFSETS)
 
     M = max(textwidth, textheight)
-    top_pad = 50  # TODO: hacky solution: add an extra H pixels on top to aovid clipping
+    top_pad = round(50 * template.scale)  # TODO: hacky solution: add an extra H pixels on top to aovid clipping
     maximum_indent = 0
-    if "eventual_indent" in template_dict["text"]:
-        indent_thresholds: list[tuple[int, int]] = []
-        for indent_dict in template_dict["text"]["eventual_indent"]:
-            indent_thresholds.append((indent_dict["at_height"], indent_dict["indent"]))
-            maximum_indent += indent_dict["indent"]
+    if template["text"].eventual_indent:
+        indent_thresholds: list[tuple[int, int]] = list(template["text"].eventual_indent)
+        maximum_indent = sum(indent for _, indent in indent_thresholds)
     else:
         indent_thresholds = [(0, 0)]
-    retimg = Image.new(
-        "RGBA", (M + top_pad + maximum_indent, M + top_pad), color=(0, 0, 0, 0)
-    )
-    draw = ImageDraw.Draw(retimg)
-    extra_inter_spacing = 20
+    size = (M + top_pad + maximum_indent, M + top_pad)
+    lines = []
+    extra_inter_spacing = round(20 * template.scale)
 
     # TODO: expose this from gui
-    min_text_font_size = 16
-    min_flavor_font_size = 11
+    min_text_font_size = max(round(16 * template.scale), 1)
+    min_flavor_font_size = max(round(11 * template.scale), 1)
     text_font_size = max(
         round(fontsize_fudge_factor * text_font_size), min_text_font_size
     )
@@ -280,36 +611,30 @@ def special_text_flavortext_handling(
         flavor_font_size = round(0.77 * flavor_font_size)
         extra_inter_spacing *= 6
 
-    for text_font_size in range(text_font_size, min_text_font_size - 1, -1):
-        # determine text size if this is what we do
-        card_text_font = ImageFont.truetype(text_font_path, size=text_font_size)
-        card_text_lines, total_card_text_height = determine_line_breaks(
-            card_text, card_text_font, draw, textwidth, card_dict["type"] == "ice"
+    with span("fit"):
+        fit = fit_text_sizes(
+            card_text,
+            text_font_path,
+            text_font_size,
+            flavor_text,
+            flavor_font_path,
+            flavor_font_size,
+            textwidth,
+            textheight,
+            extra_inter_spacing,
+            is_ice_text=card_dict["type"] == "ice",
+            min_text_font_size=min_text_font_size,
+            min_flavor_font_size=min_flavor_font_size,
         )
-
-        for flavor_font_size in range(flavor_font_size, min_flavor_font_size - 1, -1):
-            # determine maximum possible flavor text
-            if not flavor_text:
-                free_vert_space = textheight - total_card_text_height
-                break
-            flavor_font = ImageFont.truetype(flavor_font_path, size=flavor_font_size)
-            flavor_text_lines, total_flavor_text_height = determine_line_breaks(
-                flavor_text, flavor_font, draw, textwidth, False
-            )
-
-            # insist on some inter-text spacing
-            free_vert_space = textheight - (
-                total_flavor_text_height + total_card_text_height + extra_inter_spacing
-            )
-            if free_vert_space > 0:
-                # this works, so it must be the largest possible
-                break
-        else:
-            # no flavor text is small enough
-            continue
-
-        # we have found something which works here - could try more, but seems expensive
-        break
+    count("fit-iterations", fit.layout_probes)
+    if stats is not None:
+        stats["text-font-size"] = fit.text_font_size
+        stats["flavor-font-size"] = fit.flavor_font_size
+        stats["layout-passes"] = stats.get("layout-passes", 0) + fit.layout_passes
+        stats["layout-probes"] = stats.get("layout-probes", 0) + fit.layout_probes
+    text_font_size, flavor_font_size = fit.text_font_size, fit.flavor_font_size
+    card_text_lines, total_card_text_height = fit.text_lines, fit.text_height
+    flavor_text_lines, total_flavor_text_height = fit.flavor_lines, fit.flavor_height
 
     # we have determined font sizes, now determine line break size
     free_vert_space = textheight - (
@@ -337,13 +662,14 @@ def special_text_flavortext_handling(
     # TODO: here, make a temporary out-image, and return this for pasting instead
 
     x, y = 0, top_pad
+    bottom = y
 
     # finally, print everything on the image. x, y is location next line to print
 
     stuff_to_print = [
         (
             card_text_lines,
-            ImageFont.truetype(text_font_path, text_font_size),
+            load_font(text_font_path, text_font_size),
             text_font_color,
             max_text_linespacing,
         )
@@ -351,7 +677,7 @@ def special_text_flavortext_handling(
         [
             (
                 flavor_text_lines,
-                ImageFont.truetype(flavor_font_path, flavor_font_size),
+                load_font(flavor_font_path, flavor_font_size),
                 flavor_font_color,
                 max_flavor_linespacing,
             )
@@ -386,13 +712,12 @@ def special_text_flavortext_handling(
             else:
                 return None
         for line_idx, line in enumerate(text_lines, start=1):
-            if (match := re.match("^\s*<ral(\d{2})>\s*", line)):
+            if (match := QUOTE_LINE_RE.match(line)):
                 line = line[len(match.group(0)):].strip()
                 is_quote_line = True
                 quote_dedent = int(match.group(1))
             else:
                 is_quote_line = False
-            _, lineheight = get_text_dimensions(line.strip(), font)
             is_long_break = line.endswith("\n")
 
             line = line.strip()
@@ -400,11 +725,14 @@ def special_text_flavortext_handling(
             #     y += lineheight*0.25
             #     pass
 
-            line_bottom = y + lineheight
             total_indent = 0
-            for i, (height_treshold, indent_amount) in enumerate(indent_thresholds):
-                if (line_bottom - top_pad) >= height_treshold:
-                    total_indent += indent_amount
+            if template["text"].eventual_indent:
+                # measuring the ink of every line is slow, and only the indent needs it
+                _, lineheight = get_text_dimensions(line, font)
+                line_bottom = y + lineheight
+                for i, (height_treshold, indent_amount) in enumerate(indent_thresholds):
+                    if (line_bottom - top_pad) >= height_treshold:
+                        total_indent += indent_amount
 
             if (card_dict.get("twiy-style-flavortext") and is_printing_flavor) or is_quote_line:
                 line_width, _ = get_text_dimensions(line, font)
@@ -414,14 +742,9 @@ def special_text_flavortext_handling(
             else:
                 align_indent = 0
 
-            draw.text(
-                (x + total_indent + align_indent, y),
-                line,
-                font=font,
-                fill=font_color,
-                anchor="la",
-            )
+            lines.append(TextboxLine((x + total_indent + align_indent, y), line, font, font_color))
             y += lineheight_est
+            bottom = y
 
             if line_idx != len(text_lines):
                 y += long_linespacing if is_long_break else linespacing
@@ -429,7 +752,7 @@ def special_text_flavortext_handling(
         y += extra_inter_spacing + LONG_BREAK * linespacing
         is_printing_flavor = True
 
-    return retimg, top_pad
+    return TextboxLayout(size, top_pad, fit, free_vert_space, lines, bottom)
 
 
 def make_item_text(card_dict, item) -> Optional[str]:
@@ -486,36 +809,123 @@ def make_item_text(card_dict, item) -> Optional[str]:
     return text
 
 
-def factionwise_template_lookup(template_dict, faction, fieldname, propname):
-    if faction not in {
-        "anarch",
-        "criminal",
-        "haas-bioroid",
-        "jinteki",
-        "nbn",
-        "neutral-corp",
-        "neutral-runner",
-        "shaper",
-        "weyland-consortium",
-    }:
-        # must be apex, adam or sunny
-        faction = "neutral-runner"
-    prop = template_dict[fieldname][propname]
-
-    if type(prop) is dict:
-        if faction in prop:
-            assert (
-                faction in prop
-            ), f"Could not find faction {faction} in {fieldname}:{propname} dict {str(prop)}"
-            prop = prop[faction]
-        else:
-            # missing some support here...
-            assert propname == "loc"
-            assert "below-of" in prop, f"Didn't understand position directive {prop}"
-            below_field = prop["below-of"]
-            assert below_field == "text"
+def factionwise_template_lookup(template: Template, faction, fieldname, propname):
+    # apex, adam and sunny use the neutral-runner layout, see card_templates.template_faction
+    return template[fieldname].lookup(faction, propname)
+
+
+# TODO: Things will break if <strong> stuff surrounds a symbol
+HALFSPACE = "\u0230"  # TODO: this will break if creds are used outside card text
+SYMBOL_TABLE = {
+    "<em>": "",
+    "</em>": "",
+    "<li>": "\n " + chr(183) + " ",
+    # TODO: Check which of these actually need the space still - better to fix it in font editor
+    "[credit]": HALFSPACE + chr(127),
+    "[link]": chr(128),
+    "[subroutine]": SUBROUTINE_CHAR,
+    "[recurring-credit]": chr(130),
+    "[trash]": chr(131),
+    "[click]": chr(132),
+    "1[mu]": chr(134),
+    "2[mu]": chr(135),
+    "3[mu]": chr(136),
+    "[mu]": chr(137),
+    "[shaper]": chr(140) + " ",
+    "[criminal]": chr(141) + " ",
+    "[anarch]": chr(142) + " ",
+    "[haas-bioroid]": chr(143) + " ",
+    "[jinteki]": chr(144) + " ",
+    "[nbn]": chr(145) + " ",
+    "[weyland-consortium]": chr(146) + " ",
+    # The o in "don't twist me, dong ma?" is incorrect, and the font doesn't have this symbol
+    "\u01d2": "ŏ",
+}
+ERRATA_RE = re.compile("<errata>(.*?)</errata>")
+STRONG_RE = re.compile("<strong>(.*?)</strong>")
+
+
+class OffsetTable(dict):
+    """str.translate table moving every character but space by a fixed offset, filled in as needed."""
+
+    def __init__(self, offset: int):
+        super().__init__()
+        self.offset = offset
+
+    def __missing__(self, codepoint: int) -> int:
+        self[codepoint] = shifted = codepoint + (self.offset if codepoint != ord(" ") else 0)
+        return shifted
+
+
+class TextTranslator:
+    """Converts NRDB card text to font codepoints for one FontOffsets variant, in a single regex pass.
+
+    Tags are handled like they always have been: <errata> is dropped first, then <strong>,
+    then <champion>, then <trace>, and symbols last, so nothing inside a tag is treated
+    as a symbol."""
+
+    def __init__(self, font_offsets: FontOffsets):
+        self.font_offsets = font_offsets
+        self.bold = OffsetTable(font_offsets.bold)
+        self.champion = OffsetTable(font_offsets.champion)
+        # longest first, so 1[mu] wins over [mu]
+        symbols = sorted(SYMBOL_TABLE, key=len, reverse=True)
+        self.symbol_pattern = re.compile("|".join(re.escape(symbol) for symbol in symbols))
+        self.pattern = re.compile(
+            "|".join(
+                [
+                    "<errata>.*?</errata>",
+                    "<strong>(?P<strong>.*?)</strong>",
+                    "<champion>(?P<champion>.*?)</champion>",
+                    r"<trace>(?P<trace>Trace|trace) (?P<trace_strength>\S*?)</trace>",
+                ]
+                + [re.escape(symbol) for symbol in symbols]
+            )
+        )
 
-    return prop
+    def __call__(self, text: str) -> str:
+        return self.pattern.sub(self._replace, text)
+
+    def _tagged(self, text: str) -> str:
+        """What the earlier passes would have done to the inside of a tag."""
+        return ERRATA_RE.sub("", text).replace("\u01d2", "ŏ")
+
+    def _symbols(self, text: str) -> str:
+        """Symbols in tagged text are only replaced if the offset left them as they were (e.g. NO_OFFSETS)."""
+        return self.symbol_pattern.sub(lambda m: SYMBOL_TABLE[m.group(0)], text)
+
+    def _replace(self, m: re.Match) -> str:
+        if (strong := m.group("strong")) is not None:
+            return self._symbols(self._tagged(strong).translate(self.bold))
+        if (champion := m.group("champion")) is not None:
+            champion = STRONG_RE.sub(lambda sm: sm.group(1).translate(self.bold), self._tagged(champion))
+            return self._symbols(champion.translate(self.champion))
+        if (trace := m.group("trace")) is not None:
+            # Trace text is of the form <trace>Trace N</trace>, where N is a digit or X
+            # We want to make the N into a superscript. The below handles 0-9 correctly, not X.
+            return "".join(
+                [chr(ord(c) + self.font_offsets.bold) for c in trace]
+                + [
+                    chr(
+                        (ord(c) if c != "X" else (1 + ord("9")))
+                        + self.font_offsets.bold_superscript
+                    )
+                    for c in m.group("trace_strength")
+                ]
+            ) + " –"
+        if m.group(0).startswith("<errata>"):
+            return ""
+        return SYMBOL_TABLE[m.group(0)]
+
+
+@functools.lru_cache()
+def text_translator(font_offsets: FontOffsets) -> TextTranslator:
+    return TextTranslator(font_offsets)
+
+
+# (raw card text, font offsets) -> parsed text. Keyed by the text rather than the card id,
+# so edited cards (e.g. from the web form) never get stale text.
+PARSED_TEXT_CACHE = LRUCache(maxsize=8192)
 
 
 def parse_text(text: str, font_offsets: FontOffsets) -> str:
@@ -523,72 +933,38 @@ def parse_text(text: str, font_offsets: FontOffsets) -> str:
     icon symbols by the appropriate characters in the font. Use
     font_offsets to transform bold/superscript stuff (NO_OFFSETS for no change)."""
     # TODO: Must update the flavor font to include bold glyphs as well for this to be nice.
+    return PARSED_TEXT_CACHE.get(
+        (text, font_offsets), lambda: text_translator(font_offsets)(text)
+    )
 
-    # TODO: Things will break if <strong> stuff surrounds a symbol
-    HALFSPACE = "\u0230"  # TODO: this will break if creds are used outside card text
-    SYMBOL_TABLE = {
-        "": "",
-        "<em>": "",
-        "</em>": "",
-        "<li>": "\n " + chr(183) + " ",
-        # TODO: Check which of these actually need the space still - better to fix it in font editor
-        "[credit]": HALFSPACE + chr(127),
-        "[link]": chr(128),
-        "[subroutine]": SUBROUTINE_CHAR,
-        "[recurring-credit]": chr(130),
-        "[trash]": chr(131),
-        "[click]": chr(132),
-        "1[mu]": chr(134),
-        "2[mu]": chr(135),
-        "3[mu]": chr(136),
-        "[mu]": chr(137),
-        "[shaper]": chr(140) + " ",
-        "[criminal]": chr(141) + " ",
-        "[anarch]": chr(142) + " ",
-        "[haas-bioroid]": chr(143) + " ",
-        "[jinteki]": chr(144) + " ",
-        "[nbn]": chr(145) + " ",
-        "[weyland-consortium]": chr(146) + " ",
-    }
-    # The o in "don't twist me, dong ma?" is incorrect, and the font doesn't have this symbol
-    text = text.replace("\u01d2", "ŏ")
-
-    text = re.sub("<errata>(.*?)</errata>", "", text)
-    for tag in ["strong", "champion"]:
-        off = font_offsets.champion if tag == "champion" else font_offsets.bold
-        text = re.sub(
-            f"<{tag}>(.*?)</{tag}>",
-            lambda m: "".join(
-                [chr(ord(c) + (off if c != " " else 0)) for c in m.group(1)]
-            ),
-            text,
-        )
 
-    # Trace text is of the form <trace>Trace N</trace>, where N is a digit or X
-    # We want to make the N into a superscript. The below handles 0-9 correctly, not X.
-    text = re.sub(
-        r"<trace>(Trace|trace) (\S*?)</trace>",
-        lambda m: "".join(
-            [chr(ord(c) + font_offsets.bold) for c in m.group(1)]
-            + [
-                chr(
-                    (ord(c) if c != "X" else (1 + ord("9")))
-                    + font_offsets.bold_superscript
-                )
-                for c in m.group(2)
-            ]
-        )
-        + " –",
-        text,
-    )
+def preparse_cards(edn_dirs=None) -> int:
+    """Parse the text and flavor text of every card up front (into PARSED_TEXT_CACHE).
+    Returns the number of texts parsed."""
+    num_parsed = 0
+    for edn_dir in edn_dirs or [CARDS_DIR, FACES_DIR]:
+        for edn_path in sorted(Path(edn_dir).glob("*.edn")):
+            card_dict = load_card_edn(edn_path)
+            for item, font_offsets in [("text", TEXT_OFFSETS), ("flavor", FLAVOR_OFFSETS)]:
+                if isinstance(card_dict.get(item), str):
+                    parse_text(card_dict[item], font_offsets)
+                    num_parsed += 1
+    return num_parsed
 
-    for symbol, font_char in SYMBOL_TABLE.items():
-        text = text.replace(symbol, font_char)
-    return text
+
+class ItemPlacement(NamedTuple):
+    """Where a template item's text goes on the card."""
+
+    pos: tuple
+    font: ImageFont.FreeTypeFont
+    fill: tuple[int, ...]
+    box: Box
+    # rotated text is laid out as if drawn on a square of this size and rotated, None if not rotated
+    rotated_size: Optional[int] = None
 
 
 def draw_text_on_image(
-    template_dict,
+    template: Template,
     card_dict,
     item,
     text,
@@ -596,33 +972,69 @@ def draw_text_on_image(
     outimg,
     drawn_boxes: dict[TemplateItem, Box],
 ) -> Box:
+    placement = place_item(template, card_dict, item, text, drawn_boxes)
+    template_item = template[item]
+    pos, font, font_color = placement.pos, placement.font, placement.fill
+
+    if placement.rotated_size is None:
+        if template_item.backdrop:
+            bd_color = tuple(template_item.backdrop["color"])
+            width = template_item.backdrop["width"]
+            ox, oy = template_item.backdrop["offset"]
+            for dx, dy in [
+                (-width, -width),
+                (width, -width),
+                (-width, width),
+                (width, width),
+            ]:
+                draw.text(
+                    (pos[0] + dx + ox, pos[1] + dy + oy),
+                    str(text),
+                    font=font,
+                    fill=bd_color,
+                )
+
+        draw.text(pos, str(text), font=font, fill=font_color)
+    else:
+        M = placement.rotated_size
+        # Only the part of the MxM square with ink on it is drawn, and rotated with a lossless transpose
+        _, _, ink_right, ink_bottom = font.getbbox(str(text))
+        scratch_width = min(max(ink_right, 1), M)
+        tmpimg = Image.new("RGBA", (scratch_width, min(max(ink_bottom, 1), M)), color=(0, 0, 0, 0))
+        ImageDraw.Draw(tmpimg).text((0, 0), str(text), font=font, fill=font_color)
+        with span("rotate"):
+            tmpimg = tmpimg.transpose(Image.Transpose.ROTATE_90)
+            outimg.paste(tmpimg, (pos[0], pos[1] + M - scratch_width), mask=tmpimg)
+    return placement.box
+
+
+def place_item(
+    template: Template,
+    card_dict,
+    item,
+    text,
+    drawn_boxes: dict[TemplateItem, Box],
+) -> ItemPlacement:
     card_faction = card_dict["faction"]
-    pos = factionwise_template_lookup(template_dict, card_faction, item, "loc")
+    pos = factionwise_template_lookup(template, card_faction, item, "loc")
     pos = tuple(pos)
 
     if card_dict.get("id") in SPLIT_AGENDA_RELPATHS and item == TemplateItem.SET_SYM_NUM:
         # Split agendas have a logo in the lower right, so need some nudging...
-        pos = (pos[0]-130, pos[1])
-
-    font_path = str(RESOURCE_DIR / template_dict[item]["font"])
-    font_size = factionwise_template_lookup(
-        template_dict, card_faction, item, "fontsize"
-    )
-    # TODO: add support for default to factionwise_template_lookup so this can be faction-based
-    # or maybe make the template dict a separate class...
-    font_color = tuple(template_dict[item].get("fontcolor", (0, 0, 0)))
+        pos = (pos[0] - round(130 * template.scale), pos[1])
 
+    template_item = template[item]
     font_path, font_size, font_color = lookup_font_props(
-        template_dict, card_faction, item
+        template, card_faction, item
     )
     if card_dict['title'] == 'Double Down' and item == 'subtype': # Currently, this is literally the only card which cares, soooo
-        font_size -= 2
-        pos = (pos[0], pos[1]+1)
+        font_size -= round(2 * template.scale)
+        pos = (pos[0], pos[1] + round(template.scale))
 
-    font = ImageFont.truetype(font_path, size=font_size)
+    font = load_font(font_path, font_size)
 
     if item == TemplateItem.SET_SYM_NUM and text.startswith(REBOOT_INDICATOR):
-        if not template_dict[item].get("rotation"): # in this case it is top-aligned anyway
+        if not template_item.rotation: # in this case it is top-aligned anyway
             rb_icon_width, _ = get_text_dimensions(REBOOT_INDICATOR, font)
             pos = (pos[0] - rb_icon_width, pos[1])
             
@@ -630,8 +1042,8 @@ def draw_text_on_image(
     # TODO: This should be using get_text_dimensions, but then all the template offsets must be fixed
     text_width, text_height = get_text_dimensions(str(text), font)
 
-    if template_dict[item].get("center"):
-        if (rot := template_dict[item].get("rotation")) is not None:
+    if template_item.center:
+        if (rot := template_item.rotation) is not None:
             assert (
                 rot == 90
             ), "Currently do not support centering non-90 degree rotations"
@@ -640,37 +1052,22 @@ def draw_text_on_image(
             pos = (pos[0] - text_width / 2, pos[1])
 
 
-    if template_dict[item].get("rotation") is None:
-        if template_dict[item].get("backdrop"):
-            bd_color = tuple(template_dict[item]["backdrop"]["color"])
-            width = template_dict[item]["backdrop"]["width"]
-            ox, oy = template_dict[item]["backdrop"]["offset"]
-            for dx, dy in [
-                (-width, -width),
-                (width, -width),
-                (-width, width),
-                (width, width),
-            ]:
-                draw.text(
-                    (pos[0] + dx + ox, pos[1] + dy + oy),
-                    str(text),
-                    font=font,
-                    fill=bd_color,
-                )
-
-        draw.text(pos, str(text), font=font, fill=font_color)
-        return Box(
-            xmin=pos[0],
-            ymin=pos[1],
-            xmax=pos[0] + text_width,
-            ymax=pos[1] + text_height,
+    if template_item.rotation is None:
+        return ItemPlacement(
+            pos,
+            font,
+            font_color,
+            Box(
+                xmin=pos[0],
+                ymin=pos[1],
+                xmax=pos[0] + text_width,
+                ymax=pos[1] + text_height,
+            ),
         )
     else:
         # need to draw text at an angle
         # hang on to the bottom of the text to know where to start writing the time
-        assert not template_dict[item].get(
-            "backdrop"
-        ), "Backdrop and rotation not supported"
+        assert not template_item.backdrop, "Backdrop and rotation not supported"
 
         if item == "type" and card_dict["type"] == "ice":
             # Add the position from the template as an offset, because ICE:
@@ -681,54 +1078,298 @@ def draw_text_on_image(
         # TODO: See refactor comment above this function.
         text_width, text_height = new_get_text_dimensions(str(text), font)
         M = max(text_width, text_height)
-        tmpimg = Image.new("RGBA", (M, M), color=(0, 0, 0, 0))
-        ImageDraw.Draw(tmpimg).text((0, 0), str(text), font=font, fill=font_color)
-        tmpimg = tmpimg.rotate(template_dict[item].get("rotation"))
+        assert template_item.rotation == 90, "Only 90 degree rotation of text supported"
 
-        if template_dict[item].get("center"):
+        if template_item.center:
             # try to ensure the text center is placed at the pos.
             assert (
-                template_dict[item].get("rotation") == 90
+                template_item.rotation == 90
             ), "Currently do not support centering non-90 degree rotations"
             # want to change coords so that when pasting upper left corner at _pos, this ends up at pos
             pos = (pos[0] - text_height / 2, pos[1] - (M - text_width / 2))
 
         _pos = tuple(map(round, pos))
-        if template_dict[item].get("align_by_bottom_left_corner"):
-            _pos = (_pos[0], _pos[1] - tmpimg.height)
-        outimg.paste(tmpimg, _pos, mask=tmpimg)
-        return Box(
-            xmin=_pos[0],
-            ymin=_pos[1],
-            xmax=_pos[0] + text_height,
-            ymax=_pos[1] + text_width,
+        if template_item.align_by_bottom_left_corner:
+            _pos = (_pos[0], _pos[1] - M)
+        return ItemPlacement(
+            _pos,
+            font,
+            font_color,
+            Box(
+                xmin=_pos[0],
+                ymin=_pos[1],
+                xmax=_pos[0] + text_height,
+                ymax=_pos[1] + text_width,
+            ),
+            rotated_size=M,
         )
 
-def maybe_post_midlunar_resource_adjustments(template_dict: dict):
-    for k, v in list(template_dict["late_lunar_changes"].items()):
-        template_dict[k] = v
-    return template_dict
+def paste_ink(outimg, img, pos):
+    """Alpha-paste img at pos, skipping its fully transparent margins (which wouldn't change anything)."""
+    if (bbox := img.getbbox()) is None:
+        return
+    img = img.crop(bbox)
+    outimg.paste(img, (pos[0] + bbox[0], pos[1] + bbox[1]), mask=img)
+
+
+def maybe_post_midlunar_resource_adjustments(template: Template) -> Template:
+    return template.variant("late-lunar")
+
+def load_atom(template: Template, atom: str) -> Image.Image:
+    """The atom image at the template's scale. Shared, so don't draw on it."""
+    return _atom_image(template.atoms[atom], template.scale)
+
+
+@functools.lru_cache(maxsize=64)
+def _atom_image(relpath: str, scale: float) -> Image.Image:
+    img = Image.open(RESOURCE_DIR / relpath).convert("RGBA")
+    if scale != 1.0:
+        img = img.resize(tuple(max(round(scale * d), 1) for d in img.size))
+    return img
+
+
+class LayerKey(NamedTuple):
+    """Everything the static part of a card (template image, influence pips, trashcan) depends on."""
+
+    template_path: Path
+    template_mtime_ns: int
+    variants: tuple[str, ...]
+    scale: float
+    faction: str
+    template_img_relpath: str
+    influence: int
+    trashcan: bool
+    # with a background the layer is pasted over it, without one it is the card itself
+    with_background: bool
+
+
+class StaticLayer(NamedTuple):
+    image: Image.Image
+    # output size / template image size, for placing the background at template.img_offset
+    template_img_scale: float
+
+
+def image_nbytes(img: Image.Image) -> int:
+    return img.width * img.height * len(img.getbands())
+
+
+def layer_nbytes(layer: StaticLayer) -> int:
+    return image_nbytes(layer.image)
+
+
+# Full size layers are ~16MB each, so this is bounded by bytes rather than entries
+LAYER_CACHE = LRUCache(maxsize=256 * 2**20, weigh=layer_nbytes)
+# Set to a directory to also keep layers on disk, shared between processes and runs
+LAYER_CACHE_DIR: Optional[Path] = None
+# (template image relpath, output size) -> (resized template image, its scale). Decoding and resizing
+# takes ~250ms, and layers for different influence costs all start from the same template image.
+TEMPLATE_IMAGE_CACHE = LRUCache(maxsize=256 * 2**20, weigh=lambda entry: image_nbytes(entry[0]))
+
+
+def layer_cache_path(template: Template, key: LayerKey) -> Path:
+    """Disk cache file for a layer. The names include the mtimes of the PNGs used, so edited assets are picked up."""
+    sources = [key.template_img_relpath] + sorted(template.atoms.values())
+    mtimes = [(RESOURCE_DIR / relpath).stat().st_mtime_ns for relpath in sources]
+    digest = hashlib.sha1(repr((key, mtimes)).encode()).hexdigest()
+    return Path(LAYER_CACHE_DIR) / f"{digest}.layer"
+
+
+def read_layer(path: Path) -> Optional[StaticLayer]:
+    try:
+        with open(path, "rb") as f:
+            mode, width, height, template_img_scale = f.readline().decode().split()
+            image = Image.frombytes(mode, (int(width), int(height)), f.read())
+    except (OSError, ValueError):
+        return None
+    return StaticLayer(image, float(template_img_scale))
+
+
+def write_layer(path: Path, layer: StaticLayer):
+    """Stored uncompressed: PNG decoding is what the layer cache is avoiding in the first place."""
+    path.parent.mkdir(exist_ok=True, parents=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(f"{layer.image.mode} {layer.image.width} {layer.image.height} {layer.template_img_scale!r}\n".encode())
+        f.write(layer.image.tobytes())
+    os.replace(tmp_path, path)
+
+
+def template_image(relpath: str, size: tuple[int, int]) -> tuple[Image.Image, float]:
+    """A template image resized to size, and the factor it was resized by. Shared, so don't draw on it."""
+
+    def load():
+        count("template-image-decodes")
+        img = Image.open(RESOURCE_DIR / relpath).convert("RGBA")
+        return img.resize(size), size[0] / img.width
+
+    return TEMPLATE_IMAGE_CACHE.get((relpath, size), load)
 
-def make_card_proxy(card_dict, background_img_path, fudge_factor=1.0, make_alt=True, card_code="UNKNOWN_CARD_CODE"):
+
+def build_static_layer(template: Template, key: LayerKey) -> StaticLayer:
+    count("layer-builds")
+    size = tuple(round(key.scale * d) for d in CARD_SIZE)
+    template_img, template_img_scale = template_image(key.template_img_relpath, size)
+
+    atoms = []
+    if key.influence:
+        infimg = load_atom(template, "influence-pip")
+        p0, p1 = [
+            factionwise_template_lookup(template, key.faction, f"influence-{i}", "loc")
+            for i in (1, 2)
+        ]
+        for i in range(key.influence):
+            p = tuple(p0[j] + i * (p1[j] - p0[j]) for j in range(2))
+            # now center
+            p = (int(p[0] - infimg.width / 2), int(p[1] - infimg.height / 2))
+            atoms.append((infimg, p))
+    if key.trashcan:
+        atoms.append((load_atom(template, "trashcan"), tuple(template["trashcan"]["loc"])))
+
+    if key.with_background:
+        # The background goes underneath later, so stack everything with proper alpha compositing
+        layer = template_img.copy()
+        for atom, pos in atoms:
+            layer.alpha_composite(atom, pos)
+    else:
+        layer = Image.new(mode="RGBA", size=size)
+        layer.paste(template_img, mask=template_img)
+        for atom, pos in atoms:
+            layer.paste(atom, pos, mask=atom)
+    return StaticLayer(layer, template_img_scale)
+
+
+def static_layer(template: Template, key: LayerKey) -> StaticLayer:
+    """The composited template image, influence pips and trashcan for key, from memory, disk or scratch."""
+
+    def load():
+        if LAYER_CACHE_DIR is None:
+            return build_static_layer(template, key)
+        path = layer_cache_path(template, key)
+        if (layer := read_layer(path)) is None:
+            layer = build_static_layer(template, key)
+            write_layer(path, layer)
+        return layer
+
+    return LAYER_CACHE.get(key, load)
+
+
+def warm_up(scale: float = 1.0, template_images: bool = True) -> dict[str, int]:
+    """Load what rendering any card at scale needs: every template, their fonts at the template
+    sizes and their atoms, and with template_images, as many resized template images as
+    TEMPLATE_IMAGE_CACHE holds (non-full-art first). Returns how many of each were loaded."""
+    templates = [template.scaled(scale) for template in preload_templates()]
+    templates.sort(key=lambda template: template.path.stem.endswith("_alt"))
+    fonts, atoms, images = set(), set(), []
+    for template in templates:
+        for item in template.items.values():
+            if item.font_path is None:
+                continue
+            for faction in TEMPLATE_FACTIONS:
+                if isinstance(size := item.by_faction[faction].get("fontsize"), int):
+                    fonts.add((item.font_path, size))
+        atoms.update(relpath for relpath in template.atoms.values() if (RESOURCE_DIR / relpath).exists())
+        for faction in sorted(template.template_image):
+            relpath = template.template_image_relpath(faction)
+            if relpath not in images and (RESOURCE_DIR / relpath).exists():
+                images.append(relpath)
+    for font_path, size in fonts:
+        load_font(font_path, size)
+    for relpath in atoms:
+        _atom_image(relpath, scale)
+    if template_images:
+        size = tuple(round(scale * d) for d in CARD_SIZE)
+        budget = TEMPLATE_IMAGE_CACHE.maxsize // (size[0] * size[1] * 4)
+        images = images[:budget]
+        # decoding and resizing release the GIL
+        with ThreadPoolExecutor() as pool:
+            list(pool.map(lambda relpath: template_image(relpath, size), images))
+    return {
+        "templates": len(templates),
+        "fonts": len(fonts),
+        "atoms": len(atoms),
+        "template-images": len(images) if template_images else 0,
+    }
+
+
+# Set to a directory to keep backgrounds pre-scaled to the output size there, see load_background
+BACKGROUND_CACHE_DIR: Optional[Path] = None
+BACKGROUND_JPEG_QUALITY = 95
+
+
+def decode_background(background_img_path, size: tuple[int, int], mode: str = "RGBA") -> Image.Image:
+    """Decode a background resized to size. JPEGs are decoded at the smallest DCT scale that
+    is still at least size, which is many times faster for the big aligned images."""
+    count("background-decodes")
+    bg = Image.open(background_img_path)
+    if bg.format == "JPEG":
+        bg.draft("RGB", size)
+    return bg.convert(mode).resize(size)
+
+
+def background_derivative(background_img_path, size: tuple[int, int]) -> Path:
+    """Path of the background pre-scaled to size in BACKGROUND_CACHE_DIR, made if needed.
+    Named by the hash of the source, so replaced images are picked up."""
+    digest = file_digest(background_img_path)
+    path = Path(BACKGROUND_CACHE_DIR) / digest[:2] / f"{digest}_{size[0]}x{size[1]}.jpg"
+    if not path.exists():
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        # no chroma subsampling, the card is encoded once more after this
+        decode_background(background_img_path, size, mode="RGB").save(
+            tmp_path, format="JPEG", quality=BACKGROUND_JPEG_QUALITY, subsampling=0
+        )
+        os.replace(tmp_path, path)
+    return path
+
+
+def load_background(background_img_path, size: tuple[int, int]) -> Image.Image:
+    """The background resized to size, as RGBA. JPEG backgrounds come from BACKGROUND_CACHE_DIR if set
+    (other formats may have transparency, and are rare enough to not bother)."""
+    if BACKGROUND_CACHE_DIR is not None and Path(background_img_path).suffix.lower() in {".jpg", ".jpeg"}:
+        return Image.open(background_derivative(background_img_path, size)).convert("RGBA")
+    return decode_background(background_img_path, size)
+
+
+def preprocess_backgrounds(background_paths=None, scales=(1.0,)) -> int:
+    """Pre-scale backgrounds (by default every aligned image) into BACKGROUND_CACHE_DIR for each output scale,
+    so rendering only has to load an already sized image. Returns the number of derivatives checked."""
+    assert BACKGROUND_CACHE_DIR is not None, "Set BACKGROUND_CACHE_DIR first"
+    if background_paths is None:
+        background_paths = sorted(ALIGNED_IMAGES_DIR.glob("*.jpg"))
+        background_paths += sorted(ALIGNED_IMAGES_DIR.glob("special_images/*.jpg"))
+    num_derivatives = 0
+    for path in background_paths:
+        for scale in scales:
+            background_derivative(path, tuple(round(scale * d) for d in CARD_SIZE))
+            num_derivatives += 1
+    return num_derivatives
+
+
+def set_sym_num(card_code: str) -> str:
+    """The set symbol and number printed on a card, with the reboot indicator if the card was changed."""
     # WIP number printing
     try:
         cycle_idx = int(card_code[2:])
-        cycle_idx_str = str(cycle_idx)
-        if len(cycle_idx_str) == 1: # not ideal, but numbers are inconsistently wide, so need this to not have it look a little odd
-            space_prepend = "  " + chr(0x80)
-        elif len(cycle_idx_str) == 2:
-            space_prepend = " "
-        else:
-            space_prepend = ""
-        cycle_idx_str = space_prepend + cycle_idx_str # core, genesis, spin, lunar, sansan had 100+ cards
-        cycle_sym = CYCLE_SYMS[card_code[:2]]
-        if card_code in CHANGED_CARD_CODES:
-            cycle_sym = REBOOT_INDICATOR + cycle_sym
-        card_dict["set-sym-num"] = f"{cycle_sym} {cycle_idx_str}"
-
     except ValueError:
         # Couldn't guess the card code
-        card_dict["set-sym-num"] = ""
+        return ""
+    cycle_idx_str = str(cycle_idx)
+    if len(cycle_idx_str) == 1: # not ideal, but numbers are inconsistently wide, so need this to not have it look a little odd
+        space_prepend = "  " + chr(0x80)
+    elif len(cycle_idx_str) == 2:
+        space_prepend = " "
+    else:
+        space_prepend = ""
+    cycle_idx_str = space_prepend + cycle_idx_str # core, genesis, spin, lunar, sansan had 100+ cards
+    cycle_sym = CYCLE_SYMS[card_code[:2]]
+    if card_code in load_card_metadata().changed_codes:
+        cycle_sym = REBOOT_INDICATOR + cycle_sym
+    return f"{cycle_sym} {cycle_idx_str}"
+
+
+def card_template(card_dict, make_alt=True, card_code="UNKNOWN_CARD_CODE", scale: float = 1.0) -> Template:
+    """Pick the template for a card, and fill in its set symbol and number from the card code."""
+    card_dict["set-sym-num"] = set_sym_num(card_code)
     # load card data
 
     card_type = card_dict["type"]
@@ -736,13 +1377,7 @@ def make_card_proxy(card_dict, background_img_path, fudge_factor=1.0, make_alt=T
     # fetch appropriate template
     # TODO: hardcoding will break if script is symlinked, consider adding script to package instead
     # TODO: Also update the atoms
-    if make_alt:
-        template_path = RESOURCE_DIR / f"{card_type}_alt.yaml"
-    else:
-        template_path = RESOURCE_DIR / f"{card_type}.yaml"
-
-    with open(template_path) as f:
-        template_dict = yaml.safe_load(f)
+    template = load_template(card_type, alt=bool(make_alt))
 
     if card_type == "resource":
         try:
@@ -751,175 +1386,234 @@ def make_card_proxy(card_dict, background_img_path, fudge_factor=1.0, make_alt=T
             if (6 < cycle_num < 24) or (cycle_num == 6 and cycle_idx > 60):
 
                 if (cycle_num, cycle_idx) != (23, 13): # crowdfunding
-                    template_dict = maybe_post_midlunar_resource_adjustments(template_dict)
+                    template = maybe_post_midlunar_resource_adjustments(template)
         except ValueError:      # Unknown card code, so no adjustment needed
             pass
-    template_img_relpath = template_dict["template_image"][card_dict["faction"]]
-    template_img_relpath = SPLIT_AGENDA_RELPATHS.get(card_dict.get("id"), template_img_relpath)
-
     if card_dict.get('is-flip-side'):
-        template_img_relpath = template_img_relpath.replace('.png', '_flip.png')
-        template_dict['title']['fontcolor'] = [255, 255, 255] # white text on black bg instead of opposite
+        template = template.variant("flip")
     elif card_dict.get('backside-title'):
-        template_img_relpath = template_img_relpath.replace('.png', '_flipfront.png')
-
-    template_img_path = RESOURCE_DIR / template_img_relpath
+        template = template.variant("flipfront")
+    return template.scaled(scale)
 
-    # load the template image and background
-    template = Image.open(template_img_path).convert("RGBA")
-    outimg = Image.new(mode="RGBA", size=(template.width, template.height))
 
-    if background_img_path:
-        bg = Image.open(background_img_path).convert("RGBA")
-        bg = bg.resize((template.width, template.height))
-        bg_offset = template_dict.get("img_offset", [0, 0])
+def make_card_proxy(card_dict, background_img_path, fudge_factor=1.0, make_alt=True, card_code="UNKNOWN_CARD_CODE", stats: Optional[dict] = None, scale: float = 1.0):
+    """Render a card. If a stats dict is given, it is filled in with details of how the card was laid out.
+    The card is drawn directly at scale times CARD_SIZE, rather than drawn at full size and resized."""
+    with span("template"):
+        template = card_template(card_dict, make_alt=make_alt, card_code=card_code, scale=scale)
+    card_type = card_dict["type"]
 
-        outimg.paste(bg, bg_offset)
+    template_img_relpath = template.template_image_relpath(
+        card_dict["faction"], override=SPLIT_AGENDA_RELPATHS.get(card_dict.get("id"))
+    )
 
-    outimg.paste(template, mask=template)
+    # the template image, influence pips and trashcan are the same for lots of cards
+    layer_key = LayerKey(
+        template_path=template.path,
+        template_mtime_ns=template.mtime_ns,
+        variants=template.variants,
+        scale=template.scale,
+        faction=card_dict["faction"],
+        template_img_relpath=template_img_relpath,
+        influence=card_dict.get("influence-cost") or 0,
+        # add trashcan icon to trashable operations/ice
+        trashcan=card_type in {"operation", "ice"} and card_dict.get("trash-cost") is not None,
+        with_background=bool(background_img_path),
+    )
+    with span("static-layer"):
+        layer = static_layer(template, layer_key)
 
-    # TODO: could make all the template stuff relative to avoid hardcoding size
-    outimg = outimg.resize((1720, 2400))
+    if background_img_path:
+        # resized straight to the output size (some templates, e.g. identities, are drawn smaller than the card)
+        size = layer.image.size
+        outimg = Image.new(mode="RGBA", size=size)
+        with span("background"):
+            bg = load_background(background_img_path, size)
+        bg_offset = tuple(round(layer.template_img_scale * d) for d in template.img_offset)
+
+        with span("composite"):
+            outimg.paste(bg, bg_offset)
+            outimg.paste(layer.image, mask=layer.image)
+    else:
+        with span("composite"):
+            outimg = layer.image.copy()
 
     draw = ImageDraw.Draw(outimg)
 
     drawn_elements: dict[str, Box] = {}
 
-    # add inf dots
-    if card_dict.get("influence-cost"):
-        inf_pip_path = RESOURCE_DIR / template_dict["atoms"]["influence-pip"]
-        infimg = Image.open(inf_pip_path).convert("RGBA")
-        p0, p1 = [
-            factionwise_template_lookup(
-                template_dict, card_dict["faction"], f"influence-{i}", "loc"
-            )
-            for i in (1, 2)
-        ]
-        for i in range(card_dict["influence-cost"]):
-            p = tuple(p0[j] + i * (p1[j] - p0[j]) for j in range(2))
-            # now center
-            p = (int(p[0] - infimg.width / 2), int(p[1] - infimg.height / 2))
-            outimg.paste(infimg, p, mask=infimg)
-
-    # add trashcan icon to trashable operations/ice
-    if card_type in {"operation", "ice"} and card_dict.get("trash-cost") is not None:
-        trashcan_path = RESOURCE_DIR / template_dict["atoms"]["trashcan"]
-        trashcan = Image.open(trashcan_path).convert("RGBA")
-        outimg.paste(trashcan, template_dict["trashcan"]["loc"], mask=trashcan)
-
     # now write everything else on there - the point of v_offset is because the top of the text can be clipped otherwise
-    textbox_img, v_offset = special_text_flavortext_handling(
-        template_dict, card_dict, fudge_factor
-    )
-    x, y = tuple(
-        factionwise_template_lookup(template_dict, card_dict["faction"], "text", "loc")
-    )
-    if (textbox_rotation := template_dict["text"].get("rotation")) is not None:
-        assert textbox_rotation == 90, "Only 90 degree rotation of text box supported"
-        assert (
-            "eventual_indent" not in card_dict["text"]
-        ), "Cannot indent parts of text while rotating!"
-        textbox_img = textbox_img.rotate(textbox_rotation)
-        # in this case, we align by bottom left corner because convention
-        outimg.paste(
-            textbox_img, (x - v_offset, y - textbox_img.height), mask=textbox_img
+    with span("textbox"):
+        textbox_img, v_offset = special_text_flavortext_handling(
+            template, card_dict, fudge_factor, stats=stats
         )
-    else:
-        outimg.paste(textbox_img, (x, y - v_offset), mask=textbox_img)
+        x, y = tuple(
+            factionwise_template_lookup(template, card_dict["faction"], "text", "loc")
+        )
+        if (textbox_rotation := template["text"].rotation) is not None:
+            assert textbox_rotation == 90, "Only 90 degree rotation of text box supported"
+            assert (
+                "eventual_indent" not in card_dict["text"]
+            ), "Cannot indent parts of text while rotating!"
+            with span("rotate"):
+                if textbox_img.width == textbox_img.height:
+                    # what rotate() does for squares anyway
+                    textbox_img = textbox_img.transpose(Image.Transpose.ROTATE_90)
+                else:
+                    textbox_img = textbox_img.rotate(textbox_rotation)
+            # in this case, we align by bottom left corner because convention
+            with span("paste"):
+                paste_ink(outimg, textbox_img, (x - v_offset, y - textbox_img.height))
+        else:
+            with span("paste"):
+                paste_ink(outimg, textbox_img, (x, y - v_offset))
+
+    with span("items"):
+        for item_enum in TemplateItem:
+            item = item_enum.value
+            if item in {"text", "flavor"}:
+                continue
+            text = make_item_text(card_dict, item)
+        
+            if text is None or text == "":
+                continue
+
+            text = str(text)
+            with span(item):
+                drawn_elements[item_enum] = draw_text_on_image(
+                    template, card_dict, item, text, draw, outimg, drawn_elements
+                )
+
+    return outimg
+
+    # orig_path = Path(output_path).with_stem(Path(output_path).stem + "_original")
+    # bg.convert("RGB").save(orig_path)
+
 
+def layout_card(card_dict, fudge_factor=1.0, make_alt=True, card_code="UNKNOWN_CARD_CODE", scale: float = 1.0) -> dict:
+    """Dry run of make_card_proxy: fit and lay out all the text without drawing anything.
+    Returns font sizes, line counts, free space in the text box and item boxes, as JSON-able data."""
+    template = card_template(card_dict, make_alt=make_alt, card_code=card_code, scale=scale)
+    card_faction = card_dict["faction"]
+    stats = {}
+    layout = layout_textbox(template, card_dict, fudge_factor, stats=stats)
+
+    x, y = factionwise_template_lookup(template, card_faction, "text", "loc")
+    textwidth, textheight = [
+        factionwise_template_lookup(template, card_faction, "text", s) for s in ["width", "height"]
+    ]
+    _, full_text_font_size, _ = lookup_font_props(template, card_faction, "text")
+    boxes: dict[TemplateItem, Box] = {}
     for item_enum in TemplateItem:
-        item = item_enum.value
-        if item in {"text", "flavor"}:
+        if item_enum.value in {"text", "flavor"}:
             continue
-        text = make_item_text(card_dict, item)
-        
+        text = make_item_text(card_dict, item_enum.value)
         if text is None or text == "":
             continue
+        boxes[item_enum] = place_item(template, card_dict, item_enum.value, str(text), boxes).box
+
+    return {
+        "title": card_dict.get("title"),
+        "type": card_dict["type"],
+        "faction": card_faction,
+        "text-font-size": layout.fit.text_font_size,
+        "flavor-font-size": layout.fit.flavor_font_size if layout.fit.flavor_lines else None,
+        "text-shrunk": layout.fit.text_font_size < round(fudge_factor * full_text_font_size),
+        "text-lines": len(layout.fit.text_lines),
+        "flavor-lines": len(layout.fit.flavor_lines),
+        "text-height": layout.fit.text_height,
+        "flavor-height": layout.fit.flavor_height,
+        "free-vert-space": round(layout.free_vert_space, 1),
+        "overflow": layout.free_vert_space < 0,
+        "layout-passes": stats["layout-passes"],
+        # the template's text box, before any rotation
+        "text-box": [x, y, x + textwidth, y + textheight],
+        "items": {item.value: [round(v, 1) for v in box] for item, box in boxes.items()},
+    }
 
-        text = str(text)
-        drawn_elements[item_enum] = draw_text_on_image(
-            template_dict, card_dict, item, text, draw, outimg, drawn_elements
-        )
 
-    return outimg
+EDN_DIR = pathlib.Path(__file__).parent.parent / "edn"
+CARDS_DIR = EDN_DIR / "cards"
+FACES_DIR = EDN_DIR / "faces"
+CODE_DICT_PATH = Path("/home/karlerik/hobby/netrunner-data/card_image_generator/cardgen_data/code_dict.json")
+ILLUSTRATOR_DICT_PATH = Path(
+    "/home/karlerik/hobby/reteki_data/card_image_generator/cardgen_data/card_illustrator_dict.json"
+)
+ALIGNED_IMAGES_DIR = Path("/home/karlerik/hobby/aligned_images")
+PRINTING_CODES_PATH = Path(__file__).parent / "card_printing_codes.json"
+# written by helper_scripts/make_changed_card_json.py, into whichever directory it was run from
+CHANGED_CARD_CODES_PATH = Path("changed_card_codes.json")
+# everything above, precompiled by load_card_metadata
+METADATA_SNAPSHOT_PATH = Path(__file__).parent / "cardgen_data" / "metadata.snapshot"
+
+
+@functools.lru_cache()
+def load_card_metadata() -> CardMetadata:
+    """Codes, printings, illustrators, flavor and changed cards, from the snapshot. Loaded once per process."""
+    sources = MetadataSources(
+        codes=CODE_DICT_PATH,
+        printings=PRINTING_CODES_PATH,
+        illustrators=ILLUSTRATOR_DICT_PATH,
+        changed_codes=CHANGED_CARD_CODES_PATH,
+    )
+    return load_metadata(METADATA_SNAPSHOT_PATH, sources)
 
-    # orig_path = Path(output_path).with_stem(Path(output_path).stem + "_original")
-    # bg.convert("RGB").save(orig_path)
 
+def load_code_dict() -> dict[str, str]:
+    """Card id -> card code."""
+    return require(load_card_metadata().codes, CODE_DICT_PATH)
 
-def pyfy(obj):
-    """Transform clojure-y objects into the Python analogues."""
-    if type(obj) is edn_format.edn_lex.Keyword:
-        return str(obj)[1:]
-    elif type(obj) is edn_format.immutable_list.ImmutableList:
-        return [pyfy(subobj) for subobj in obj]
-    else:
-        return obj
 
+def load_illustrator_dict() -> dict[str, dict]:
+    """Card code -> illustrator/flavor."""
+    return require(load_card_metadata().illustrators, ILLUSTRATOR_DICT_PATH)
 
-def parse_input_and_doit():
-    make_alt = False  # TODO: add option
-    try:
-        edn_path = sys.argv[1]
-        with open(edn_path) as f:
-            d = edn_format.edn_parse.parse(f.read())
-            card_dict = {pyfy(k): pyfy(v) for k, v in d.items()}
 
-        output_path = sys.argv[2]
-        code_dict = yaml.safe_load(
-            Path("/home/karlerik/hobby/netrunner-data/card_image_generator/cardgen_data/code_dict.json").read_text()
-        )
-        card_name = Path(edn_path).stem
-        _card_name = card_dict.get("id")  # TODO: hack...
-        _card_code = code_dict.get(_card_name, "UNKNOWN_CARD_CODE")
-        card_code = code_dict.get(card_name, "UNKNOWN_CARD_CODE")
+@functools.lru_cache()
+def load_carddb() -> carddb.CardDB:
+    """Every card in EDN_DIR, from its snapshot. Loaded once per process."""
+    return carddb.load(EDN_DIR)
 
-        if card_code == "UNKNOWN_CARD_CODE" and card_name.endswith("-front") or card_name.endswith("-back"):
-            card_code = code_dict.get("-".join(card_name.split("-")[:-1]), "UNKNOWN_CARD_CODE")
-        
 
-        # horrible hack...
-        if len(sys.argv) > 4 and sys.argv[4] == "--font-fudge":
-            fudge_factor = float(sys.argv[5])
-            sys.argv = sys.argv[:4] + sys.argv[6:]
-        elif "font-fudge-factor" in card_dict and not make_alt:
-            fudge_factor = card_dict.pop("font-fudge-factor")
-        else:
-            fudge_factor = 1.0
+def _in_dir(path: Path, directory: Path) -> bool:
+    return path.resolve().parent == directory.resolve()
 
-        background_img_path = f"/home/karlerik/hobby/aligned_images/{card_code}.jpg"
-        if card_name in ['sync-front', 'sync-back', 'biotech-front', 'biotech-brewery', 'biotech-greenhouse', 'biotech-tank']:
-            background_img_path = f"/home/karlerik/hobby/aligned_images/special_images/{card_name.replace('-', '_')}.jpg"
-        if not pathlib.Path(background_img_path).exists():
-            background_img_path = sys.argv[3]
-            assert pathlib.Path(
-                background_img_path
-            ).exists(), "background image doesn't exist??"
 
-    except IndexError as e:
-        print(
-            "Usage: python proxygen.py path_to_card_data_edn output_image_path <optional: background_image_path>"
-        )
-        sys.exit(1)
+def load_card_edn(edn_path) -> dict:
+    edn_path = Path(edn_path)
+    if _in_dir(edn_path, CARDS_DIR) or _in_dir(edn_path, FACES_DIR):
+        db = load_carddb()
+        card = (db.cards if _in_dir(edn_path, CARDS_DIR) else db.faces).get(edn_path.stem)
+        if card is not None:
+            # callers fill in the card dict, so they get their own
+            return {k: list(v) if isinstance(v, list) else v for k, v in card.data.items()}
+    return card_edn.read(edn_path)
 
-    with open(
-        "/home/karlerik/hobby/reteki_data/card_image_generator/cardgen_data/card_illustrator_dict.json"
-    ) as f:
-        illustrator_dict = json.load(f)
+
+def find_background_image(card_code: str, card_name: str) -> Optional[str]:
+    """Return the aligned background for this card, if we have one."""
+    if card_name in SPECIAL_FACES:
+        background_img_path = ALIGNED_IMAGES_DIR / SPECIAL_FACES[card_name][1]
+    else:
+        background_img_path = ALIGNED_IMAGES_DIR / f"{card_code}.jpg"
+    return str(background_img_path) if background_img_path.exists() else None
+
+
+def add_card_metadata(card_dict: dict, card_code: str, illustrator_code: str) -> dict:
+    """Fill in illustrator/flavor/etc. which aren't part of the card EDN."""
+    illustrator_dict = load_illustrator_dict()
     if (
         "illustrator" not in card_dict
-        and _card_code in illustrator_dict
-        and "illustrator" in illustrator_dict[_card_code]
+        and illustrator_code in illustrator_dict
+        and "illustrator" in illustrator_dict[illustrator_code]
     ):
-        card_dict["illustrator"] = illustrator_dict[_card_code]["illustrator"]
+        card_dict["illustrator"] = illustrator_dict[illustrator_code]["illustrator"]
     if "illustrator" in card_dict:
         card_dict["illustrator"] = f'Illus.: {card_dict["illustrator"]}'
 
-
     # DEV STUFF
     card_dict["set-sym-num"] = " 25"
-        
-    make_alt = False  # TODO: add option
+
     if "flavor" not in card_dict and (
         flavor := illustrator_dict.get(card_code, {}).get("flavor")
     ):
@@ -932,30 +1626,640 @@ def parse_input_and_doit():
 
     if "strength" not in card_dict and card_dict["type"] == "program":
         card_dict["strength"] = "–"
+    return card_dict
+
+
+# Bump when a change to the renderer changes what cards look like, so render caches don't serve stale images
+RENDERER_VERSION = 2
+
+
+class RenderInputs(NamedTuple):
+    """What rendering a card reads, besides the card dict itself."""
+
+    files: list[Path]  # template YAML, images, fonts and background image
+    template_path: Optional[Path]
+    template_keys: list[str]  # top-level template YAML keys used, atoms as "atoms.{name}"
 
+
+def render_inputs(card_dict, background_img_path, make_alt=False, card_code="UNKNOWN_CARD_CODE") -> RenderInputs:
+    """Work out which files and template entries make_card_proxy would use for a card, without rendering it."""
     if minifaction := PREMADE_IDS.get(card_code):
-        proxy_img_path = RESOURCE_DIR / "odd_cards" / f"{minifaction}.jpg"
-        Path(output_path).write_bytes(proxy_img_path.read_bytes())
-        q = 95
-        Image.open(proxy_img_path).save(
-            output_path,
-            **(
-                {"quality": q}
-                if output_path.lower().split(".")[-1] in {"jpg", "jpeg"}
-                else {}
-            ),
+        return RenderInputs([RESOURCE_DIR / "odd_cards" / f"{minifaction}.jpg"], None, [])
+    # card_template fills in the set symbol, which make_item_text needs
+    card_dict = dict(card_dict)
+    template = card_template(card_dict, make_alt=make_alt, card_code=card_code)
+    template_img_relpath = template.template_image_relpath(
+        card_dict["faction"], override=SPLIT_AGENDA_RELPATHS.get(card_dict.get("id"))
+    )
+
+    keys = ["template_image", "text", "flavor"]
+    keys += [
+        item.value
+        for item in TemplateItem
+        if item.value not in {"text", "flavor"} and make_item_text(card_dict, item.value) not in {None, ""}
+    ]
+    if card_dict.get("influence-cost"):
+        keys += ["influence-1", "influence-2", "atoms.influence-pip"]
+    if card_dict["type"] in {"operation", "ice"} and card_dict.get("trash-cost") is not None:
+        keys += ["trashcan", "atoms.trashcan"]
+    if background_img_path:
+        keys.append("img_offset")
+    if "late-lunar" in template.variants:
+        keys.append("late_lunar_changes")
+
+    files = [template.path, RESOURCE_DIR / template_img_relpath]
+    atoms = [key.removeprefix("atoms.") for key in keys if key.startswith("atoms.")]
+    files += [RESOURCE_DIR / template.atoms[atom] for atom in atoms if atom in template.atoms]
+    files += sorted({Path(template[key].font_path) for key in keys if key in template and template[key].font_path})
+    if background_img_path:
+        files.append(Path(background_img_path))
+    return RenderInputs(files, template.path, keys)
+
+
+def _json_default(obj):
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=str)
+    return str(obj)
+
+
+def card_dict_digest(card_dict) -> str:
+    return content_key(json.dumps(card_dict, sort_keys=True, default=_json_default))
+
+
+def render_cache_key(
+    card_dict,
+    background_img_path,
+    fudge_factor: float,
+    make_alt: bool,
+    card_code: str,
+    scale: float,
+    fmt: ImageFormat,
+    preset: str,
+) -> str:
+    """Hash of everything that affects the encoded image of a card, for RenderCache."""
+    dependencies = render_inputs(card_dict, background_img_path, make_alt=make_alt, card_code=card_code).files
+    return content_key(
+        RENDERER_VERSION,
+        card_dict_digest(card_dict),
+        # filled in by card_template, from the card code and changed_card_codes.json
+        None if card_code in PREMADE_IDS else set_sym_num(card_code),
+        # some templates refer to atoms that don't exist, and just never use them
+        [file_digest(path) if path.exists() else None for path in dependencies],
+        fudge_factor,
+        bool(make_alt),
+        card_code,
+        scale,
+        fmt.value,
+        preset,
+        # pre-scaled backgrounds went through one more JPEG encode
+        BACKGROUND_CACHE_DIR is not None,
+    )
+
+
+def render_card(
+    edn_path,
+    output_path,
+    background_img_path: Optional[str] = None,
+    fudge_factor: Optional[float] = None,
+    card_code: Optional[str] = None,
+    make_alt: bool = False,
+    stats: Optional[dict] = None,
+    scale: float = 1.0,
+    preset: str = "print",
+    cache: Optional[RenderCache] = None,
+) -> str:
+    """Render the card described by edn_path to output_path, returning the card code used.
+    See render_card_image for the arguments, preset is one of card_encoders.PRESETS.
+    With a cache, cards which haven't changed since they were last rendered are copied from it."""
+    rendered = render_or_fetch(
+        edn_path, format_for_path(output_path), background_img_path, fudge_factor, card_code, make_alt, stats,
+        scale, preset, cache,
+    )
+    if rendered.data is None:
+        save_rendered(rendered.image, output_path, preset, cache, rendered.cache_key)
+    else:
+        Path(output_path).write_bytes(rendered.data)
+    return rendered.card_code
+
+
+class CardRender(NamedTuple):
+    """A rendered card, or its encoded image if it came from a render cache."""
+
+    card_code: str
+    image: Optional[Image.Image]
+    data: Optional[bytes]
+    cache_key: Optional[str]
+
+
+def render_or_fetch(
+    edn_path,
+    fmt: ImageFormat,
+    background_img_path: Optional[str] = None,
+    fudge_factor: Optional[float] = None,
+    card_code: Optional[str] = None,
+    make_alt: bool = False,
+    stats: Optional[dict] = None,
+    scale: float = 1.0,
+    preset: str = "print",
+    cache: Optional[RenderCache] = None,
+) -> CardRender:
+    """Render a card, unless it's in the cache already. Pass the result to encode_rendered/save_rendered."""
+    with span("prepare"):
+        card_dict, card_code, fudge_factor = prepare_card_dict(edn_path, fudge_factor, card_code, make_alt)
+        background_img_path = card_background(card_code, Path(edn_path).stem, background_img_path)
+    if stats is not None:
+        stats["type"], stats["faction"] = card_dict.get("type"), card_dict.get("faction")
+    key = None
+    if cache is not None:
+        with span("cache"):
+            key = render_cache_key(card_dict, background_img_path, fudge_factor, make_alt, card_code, scale, fmt, preset)
+            data = cache.get(key, fmt.suffix)
+        if stats is not None:
+            stats["cached"] = data is not None
+        if data is not None:
+            return CardRender(card_code, None, data, key)
+    outimg = card_image(card_dict, card_code, background_img_path, fudge_factor, make_alt, stats, scale)
+    return CardRender(card_code, outimg, None, key)
+
+
+def encode_rendered(
+    img, fmt: ImageFormat, preset: str = "print", cache: Optional[RenderCache] = None, key: Optional[str] = None
+) -> bytes:
+    """Encode a rendered card, also storing it in cache under key if given."""
+    with span("encode"):
+        data = encode(img, fmt, preset)
+    if cache is not None:
+        with span("cache"):
+            cache.put(key, fmt.suffix, data)
+    return data
+
+
+def save_rendered(img, output_path, preset: str = "print", cache: Optional[RenderCache] = None, key: Optional[str] = None):
+    Path(output_path).write_bytes(encode_rendered(img, format_for_path(output_path), preset, cache, key))
+
+
+def render_card_image(
+    edn_path,
+    background_img_path: Optional[str] = None,
+    fudge_factor: Optional[float] = None,
+    card_code: Optional[str] = None,
+    make_alt: bool = False,
+    stats: Optional[dict] = None,
+    scale: float = 1.0,
+) -> tuple[Image.Image, str]:
+    """Render the card described by edn_path, returning the image and the card code used.
+
+    If card_code isn't given, it is guessed from the file name like the CLI always has.
+    The aligned background image is preferred, background_img_path is a fallback.
+    scale renders at a fraction of the full CARD_SIZE, e.g. for thumbnails."""
+    card_dict, card_code, fudge_factor = prepare_card_dict(edn_path, fudge_factor, card_code, make_alt)
+    background_img_path = card_background(card_code, Path(edn_path).stem, background_img_path)
+    outimg = card_image(card_dict, card_code, background_img_path, fudge_factor, make_alt, stats, scale)
+    return outimg, card_code
+
+
+def card_background(card_code: str, card_name: str, background_img_path: Optional[str] = None) -> str:
+    background_img_path = find_background_image(card_code, card_name) or background_img_path
+    assert background_img_path is not None and pathlib.Path(
+        background_img_path
+    ).exists(), "background image doesn't exist??"
+    return background_img_path
+
+
+def card_image(
+    card_dict, card_code: str, background_img_path, fudge_factor: float, make_alt: bool, stats: Optional[dict], scale: float
+) -> Image.Image:
+    """render_card_image for a card dict from prepare_card_dict."""
+    if minifaction := PREMADE_IDS.get(card_code):
+        with span("premade"):
+            proxy_img_path = RESOURCE_DIR / "odd_cards" / f"{minifaction}.jpg"
+            outimg = Image.open(proxy_img_path)
+            if scale != 1.0:
+                outimg = outimg.resize(tuple(round(scale * d) for d in outimg.size))
+        return outimg
+    return make_card_proxy(
+        card_dict, background_img_path, fudge_factor=fudge_factor, make_alt=make_alt, card_code=card_code,
+        stats=stats, scale=scale,
+    )
+
+
+def prepare_card_dict(
+    edn_path, fudge_factor: Optional[float] = None, card_code: Optional[str] = None, make_alt: bool = False
+) -> tuple[dict, str, float]:
+    """Load a card's EDN and add what rendering needs to it. Returns the card dict, card code and fudge factor."""
+    card_dict = load_card_edn(edn_path)
+    card_name = Path(edn_path).stem
+    if card_code is None:
+        code_dict = load_code_dict()
+        _card_name = card_dict.get("id")  # TODO: hack...
+        illustrator_code = code_dict.get(_card_name, "UNKNOWN_CARD_CODE")
+        card_code = code_dict.get(card_name, "UNKNOWN_CARD_CODE")
+
+        if card_code == "UNKNOWN_CARD_CODE" and card_name.endswith("-front") or card_name.endswith("-back"):
+            card_code = code_dict.get("-".join(card_name.split("-")[:-1]), "UNKNOWN_CARD_CODE")
+    else:
+        illustrator_code = card_code
+
+    if fudge_factor is None:
+        if "font-fudge-factor" in card_dict and not make_alt:
+            fudge_factor = card_dict.pop("font-fudge-factor")
+        else:
+            fudge_factor = 1.0
+
+    card_dict = add_card_metadata(card_dict, card_code, illustrator_code)
+    return card_dict, card_code, fudge_factor
+
+
+def layout_edn(edn_path, fudge_factor: Optional[float] = None, make_alt: bool = False) -> dict:
+    """layout_card for an EDN file, with the same card code and fudge factor render_card would use."""
+    result = {"file": str(edn_path)}
+    try:
+        card_dict, card_code, fudge_factor = prepare_card_dict(edn_path, fudge_factor, make_alt=make_alt)
+        result.update({"card-code": card_code, "font-fudge-factor": fudge_factor})
+        if card_code in PREMADE_IDS:
+            result["premade"] = True
+        else:
+            result.update(layout_card(card_dict, fudge_factor, make_alt=make_alt, card_code=card_code))
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def layout_main(argv: list[str]):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="proxygen.py --layout",
+        description="Lay out cards without rendering them, printing one JSON object per card. "
+        "For finding cards whose text overflows or needs a font-fudge-factor.",
+    )
+    parser.add_argument("paths", nargs="*", help="EDN files or directories (default: edn/cards and edn/faces)")
+    parser.add_argument("-o", "--out", help="write JSON lines here instead of stdout")
+    parser.add_argument("--font-fudge", type=float, default=None)
+    parser.add_argument("--alt", action="store_true", help="lay out the full-art version")
+    args = parser.parse_args(argv)
+
+    edn_paths = []
+    for path in map(Path, args.paths or [CARDS_DIR, FACES_DIR]):
+        edn_paths += sorted(path.glob("*.edn")) if path.is_dir() else [path]
+
+    start = time.perf_counter()
+    counts = {"overflow": 0, "text-shrunk": 0, "error": 0}
+    out = open(args.out, "w") if args.out else sys.stdout
+    try:
+        for edn_path in edn_paths:
+            result = layout_edn(edn_path, args.font_fudge, make_alt=args.alt)
+            for key in counts:
+                counts[key] += bool(result.get(key))
+            print(json.dumps(result), file=out)
+    finally:
+        if args.out:
+            out.close()
+    print(
+        f"Laid out {len(edn_paths)} cards in {time.perf_counter() - start:.2f}s: {counts['overflow']} overflowing, "
+        f"{counts['text-shrunk']} with shrunk text, {counts['error']} failed",
+        file=sys.stderr,
+    )
+
+
+class BatchJob(NamedTuple):
+    card_id: str
+    card_code: Optional[str]
+    edn_path: Path
+    output_stem: str
+
+
+# Rendered images waiting to be encoded in render_batch - a full size card is ~16MB
+MAX_PENDING_SAVES = 4
+
+
+class BatchResult(NamedTuple):
+    job: BatchJob
+    output_path: Path
+    seconds: float
+    error: Optional[str]
+    stats: dict
+
+
+def card_faces(card_id: str, card_code: Optional[str]) -> list[tuple[Path, str]]:
+    """Return (edn path, output name suffix) for every face of a card.
+    Multi-faced cards are named {code}_front, {code}_back or {code}_back_N."""
+    special_faces = [name for name, (code, _) in SPECIAL_FACES.items() if code == card_code]
+    if special_faces:
+        face_paths = [FACES_DIR / f"{name}.edn" for name in special_faces]
+    else:
+        face_paths = sorted(FACES_DIR.glob(f"{card_id}-front.edn")) + sorted(
+            FACES_DIR.glob(f"{card_id}-back*.edn")
         )
+    if not face_paths:
+        return [(CARDS_DIR / f"{card_id}.edn", "")]
+
+    front = [p for p in face_paths if p.stem.endswith("-front")]
+    backs = sorted(p for p in face_paths if not p.stem.endswith("-front"))
+    faces = [(p, "_front") for p in front]
+    if len(backs) == 1:
+        faces.append((backs[0], "_back"))
+    else:
+        faces += [(p, f"_back_{i}") for i, p in enumerate(backs, start=1)]
+    return faces
+
 
+def batch_jobs(cards) -> list[BatchJob]:
+    """cards is either the path to a set-cards EDN file, or an iterable of card ids."""
+    if isinstance(cards, (str, Path)) and _in_dir(Path(cards), EDN_DIR / "set-cards"):
+        id_codes = [(p.card_id, p.code) for p in load_carddb().set_printings(Path(cards).stem)]
+    elif isinstance(cards, (str, Path)):
+        id_codes = [(d["card-id"], d["code"]) for d in card_edn.read(cards)]
     else:
-        outimg = make_card_proxy(
-            card_dict, background_img_path, fudge_factor=fudge_factor, make_alt=make_alt, card_code=card_code
+        code_dict = load_code_dict()
+        id_codes = [(card_id, code_dict.get(card_id)) for card_id in cards]
+
+    jobs = []
+    for card_id, card_code in id_codes:
+        for edn_path, face_suffix in card_faces(card_id, card_code):
+            jobs.append(
+                BatchJob(card_id, card_code, edn_path, f"{card_code or card_id}{face_suffix}")
+            )
+    return jobs
+
+
+def render_batch(
+    cards,
+    output_dir,
+    background_img_path: Optional[str] = None,
+    suffix: str = "jpg",
+    fudge_factor: Optional[float] = None,
+    make_alt: bool = False,
+    verbose: bool = True,
+    scale: float = 1.0,
+    preset: str = "print",
+    cache: Optional[RenderCache] = None,
+    profile: bool = False,
+) -> list[BatchResult]:
+    """Render every card (and every face of it) in one process.
+
+    cards is a set-cards EDN path or a list of card ids, see batch_jobs. Failures are
+    reported in the results rather than aborting the whole batch. Images are encoded
+    in the background while the next card renders. With a cache, unchanged cards are
+    copied from it instead of rendered. With profile, each result's stats has a
+    card_profile.Profile of the card under "profile", see profile_record."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
+
+    results = []
+    pending = []  # (index in results, future saving the image)
+
+    def finish_saving(index, saving):
+        try:
+            saving.result()
+        except Exception as e:
+            results[index] = results[index]._replace(error=f"{type(e).__name__}: {e}")
+            if verbose:
+                print(f"{results[index].job.output_stem} ({results[index].job.card_id}): FAILED {results[index].error}")
+
+    for job in batch_jobs(cards):
+        output_path = output_dir / f"{job.output_stem}.{suffix}"
+        t0 = time.perf_counter()
+        stats = {"profile": Profile()} if profile else {}
+        rendered = None
+        try:
+            with activated(stats.get("profile")):
+                rendered = render_or_fetch(
+                    job.edn_path, format_for_path(output_path), background_img_path, fudge_factor, job.card_code,
+                    make_alt, stats, scale, preset, cache,
+                )
+            if rendered.data is not None:
+                output_path.write_bytes(rendered.data)
+            error = None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        results.append(BatchResult(job, output_path, time.perf_counter() - t0, error, stats))
+        if verbose:
+            status = "FAILED " + error if error else f"{results[-1].seconds:.2f}s"
+            if stats.get("cached"):
+                status += " (cached)"
+            print(f"{job.output_stem} ({job.card_id}): {status}")
+        if rendered is not None and rendered.image is not None:
+            saving = encoder_pool().submit(
+                call_in, stats.get("profile"), save_rendered, rendered.image, output_path, preset, cache,
+                rendered.cache_key,
+            )
+            pending.append((len(results) - 1, saving))
+        # don't let rendered images pile up in memory if encoding can't keep up
+        while len(pending) > MAX_PENDING_SAVES:
+            finish_saving(*pending.pop(0))
+    for index, saving in pending:
+        finish_saving(index, saving)
+    return results
+
+
+def profile_record(result: BatchResult) -> dict:
+    """A JSON line for card_profile: the card, its type and faction, and where its time went."""
+    record = {
+        "card": result.job.output_stem,
+        "card_id": result.job.card_id,
+        "card_code": result.job.card_code,
+        "type": result.stats.get("type"),
+        "faction": result.stats.get("faction"),
+        "cached": bool(result.stats.get("cached")),
+        "error": result.error,
+    }
+    if (profile := result.stats.get("profile")) is not None:
+        record.update(profile.as_dict())
+    return record
+
+
+def write_profile(results: list[BatchResult], path):
+    with open(path, "a") as f:
+        for result in results:
+            f.write(json.dumps(profile_record(result)) + "\n")
+
+
+def print_timing_summary(results: list[BatchResult], file=sys.stdout):
+    rendered = [r for r in results if r.error is None]
+    failed = [r for r in results if r.error is not None]
+    total = sum(r.seconds for r in results)
+    print(f"\n{'card':<24}{'id':<40}{'seconds':>8}{'layouts':>9}", file=file)
+    for r in sorted(rendered, key=lambda r: -r.seconds):
+        print(
+            f"{r.job.output_stem:<24}{r.job.card_id:<40}{r.seconds:>8.3f}"
+            f"{r.stats.get('layout-passes', 0):>9}",
+            file=file,
+        )
+    for r in failed:
+        print(f"{r.job.output_stem:<24}{r.job.card_id:<40}  {r.error}", file=file)
+    if rendered:
+        mean = sum(r.seconds for r in rendered) / len(rendered)
+        print(f"\nRendered {len(rendered)} faces in {total:.2f}s ({mean:.3f}s/face)", file=file)
+        if num_cached := sum(bool(r.stats.get("cached")) for r in rendered):
+            print(f"{num_cached} faces were unchanged and copied from the render cache", file=file)
+    if failed:
+        print(f"{len(failed)} faces failed", file=file)
+    caches = [
+        ("Font", FONT_CACHE),
+        ("Layout", LAYOUT_CACHE),
+        ("Measurement", TEXT_MEASURER),
+        ("Parse", PARSED_TEXT_CACHE),
+        ("Layer", LAYER_CACHE),
+        ("Template image", TEMPLATE_IMAGE_CACHE),
+    ]
+    for name, cache in caches:
+        cache_stats = cache.stats()
+        print(
+            f"{name} cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+            f"{cache_stats['evictions']} evictions",
+            file=file,
+        )
+
+
+def batch_main(argv: list[str]):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="proxygen.py --batch",
+        description="Render a whole set (or a list of card ids) in a single process.",
+    )
+    parser.add_argument("cards", nargs="+", help="path to a set-cards EDN file, or card ids")
+    parser.add_argument("-o", "--out-dir", required=True)
+    parser.add_argument("--background", help="background to use when no aligned image exists")
+    parser.add_argument("--suffix", default="jpg", help="jpg, png, webp or avif")
+    parser.add_argument("--preset", default="print", choices=sorted(PRESETS))
+    parser.add_argument("--font-fudge", type=float, default=None)
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="render at this fraction of the full 1720x2400 size"
+    )
+    parser.add_argument("--layer-cache-dir", help="also keep composited template layers on disk here")
+    parser.add_argument(
+        "--cache-dir", help="keep rendered cards here, and only re-render cards which changed since"
+    )
+    parser.add_argument("--cache-size", type=int, default=2048, help="size limit of --cache-dir in MB")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="render on this many worker processes (0 for one per core)"
+    )
+    parser.add_argument(
+        "--preparse", action="store_true", help="parse the text of every card in edn/ before rendering"
+    )
+    parser.add_argument("--background-cache-dir", help="keep backgrounds pre-scaled to the output size here")
+    parser.add_argument(
+        "--prescale-backgrounds",
+        action="store_true",
+        help="pre-scale every aligned image into --background-cache-dir before rendering",
+    )
+    parser.add_argument(
+        "--profile", metavar="JSONL", help="append where each card's render time went to this file, and summarise it"
+    )
+    args = parser.parse_args(argv)
+    if args.prescale_backgrounds and not args.background_cache_dir:
+        parser.error("--prescale-backgrounds needs --background-cache-dir")
+
+    if args.layer_cache_dir:
+        global LAYER_CACHE_DIR
+        LAYER_CACHE_DIR = Path(args.layer_cache_dir)
+
+    if args.background_cache_dir:
+        global BACKGROUND_CACHE_DIR
+        BACKGROUND_CACHE_DIR = Path(args.background_cache_dir)
+    if args.prescale_backgrounds:
+        start = time.perf_counter()
+        num_prescaled = preprocess_backgrounds(scales=(args.scale,))
+        print(f"Pre-scaled {num_prescaled} backgrounds in {time.perf_counter() - start:.2f}s")
+
+    if args.preparse:
+        start = time.perf_counter()
+        num_parsed = preparse_cards()
+        print(f"Parsed {num_parsed} card texts in {time.perf_counter() - start:.2f}s")
+
+    if len(args.cards) == 1 and args.cards[0].endswith(".edn"):
+        cards = Path(args.cards[0])
+    else:
+        cards = args.cards
+
+    if args.jobs != 1:
+        from card_render_pool import RenderSettings, render_parallel
+
+        settings = RenderSettings(
+            output_dir=Path(args.out_dir),
+            suffix=args.suffix,
+            background_img_path=args.background,
+            fudge_factor=args.font_fudge,
+            scale=args.scale,
+            preset=args.preset,
+            cache_dir=args.cache_dir,
+            cache_max_bytes=args.cache_size * 2**20,
+            profile=bool(args.profile),
+            layer_cache_dir=args.layer_cache_dir,
+            background_cache_dir=args.background_cache_dir,
+        )
+        results = []
+        for result in render_parallel(batch_jobs(cards), settings, processes=args.jobs or None):
+            status = "FAILED " + result.error if result.error else f"{result.seconds:.2f}s"
+            print(f"{result.job.output_stem} ({result.job.card_id}): {status}")
+            results.append(result)
+    else:
+        results = render_batch(
+            cards,
+            args.out_dir,
+            background_img_path=args.background,
+            suffix=args.suffix,
+            fudge_factor=args.font_fudge,
+            scale=args.scale,
+            preset=args.preset,
+            cache=RenderCache(args.cache_dir, max_bytes=args.cache_size * 2**20) if args.cache_dir else None,
+            profile=bool(args.profile),
         )
-        # convert to RGB to apply transparency mask from template, PIL is weird about it otherwise
-        q = 95
-        output_suffix = output_path.lower().split(".")[-1]
-        outimg.convert("RGB").save(
-            output_path, **({"quality": q} if output_suffix in {"jpg", "jpeg"} else {})
+    print_timing_summary(results)
+    if args.profile:
+        from card_profile import print_report
+
+        write_profile(results, args.profile)
+        print_report(profile_record(r) for r in results)
+    sys.exit(1 if any(r.error for r in results) else 0)
+
+
+def parse_input_and_doit():
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        batch_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "--layout":
+        layout_main(sys.argv[2:])
+        sys.exit(0)
+
+    try:
+        if "--profile" in sys.argv:
+            i = sys.argv.index("--profile")
+            profile_path = sys.argv[i + 1]
+            sys.argv = sys.argv[:i] + sys.argv[i + 2:]
+        else:
+            profile_path = None
+        edn_path = sys.argv[1]
+        output_path = sys.argv[2]
+        background_img_path = sys.argv[3] if len(sys.argv) > 3 else None
+
+        # horrible hack...
+        if len(sys.argv) > 4 and sys.argv[4] == "--font-fudge":
+            fudge_factor = float(sys.argv[5])
+            sys.argv = sys.argv[:4] + sys.argv[6:]
+        else:
+            fudge_factor = None
+    except IndexError as e:
+        print(
+            "Usage: python proxygen.py path_to_card_data_edn output_image_path <optional: background_image_path> "
+            "[--profile profile.jsonl]\n"
+            "       python proxygen.py --batch (set_cards_edn | card_id...) -o output_dir\n"
+            "       python proxygen.py --layout [edn_file_or_dir...]"
+        )
+        sys.exit(1)
+
+    if profile_path is None:
+        render_card(edn_path, output_path, background_img_path=background_img_path, fudge_factor=fudge_factor)
+        return
+    stats = {"profile": Profile()}
+    t0 = time.perf_counter()
+    with activated(stats["profile"]):
+        card_code = render_card(
+            edn_path, output_path, background_img_path=background_img_path, fudge_factor=fudge_factor, stats=stats
         )
+    job = BatchJob(Path(edn_path).stem, card_code, Path(edn_path), Path(output_path).stem)
+    write_profile([BatchResult(job, Path(output_path), time.perf_counter() - t0, None, stats)], profile_path)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,42 @@
+"""The card generator web app.
+
+Cards are rendered in a bounded pool of worker processes, see RENDER_PROCESSES. What
+rendering needs (templates, fonts, atoms and the template images resized for the live
+preview) is loaded once, in the fork server they're started from, while the app already
+answers, see WARM_UP and /ready.
+
+    gunicorn -c gunicorn.conf.py proxygenserver:app
+"""
+import gc
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 from enum import Enum
 from io import BytesIO
-
-from flask import Flask, make_response, render_template, request
+from typing import Iterator, NamedTuple, Optional
+
+from card_encoders import ImageFormat, is_supported
+from card_render_cache import content_key
+from card_render_pool import (
+    BoundedPool,
+    PoolBusy,
+    WebWarmUp,
+    render_web_card,
+    warm_up_web,
+    web_worker_init,
+    web_worker_state,
+)
+from flask import Flask, Response, jsonify, make_response, render_template, request
 from PIL import Image
-from proxygen import make_card_proxy
+from proxygen import LRUCache, render_cache_key
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 
@@ -16,6 +49,73 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1000 * 1000
 # Assumes we are behind reverse-proxy - otherwise comment this out
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
+# Cards are drawn straight at this fraction of the full print size
+PREVIEW_SCALE = 0.7
+# and for the live preview while the form is being edited, which should take tens of milliseconds
+LIVE_PREVIEW_SCALE = 0.25
+
+# Served to clients that list them in Accept, best first. WebP comes first because it
+# is about half the size of the JPEG and encodes just as fast, while AVIF takes ~1s.
+NEGOTIATED_FORMATS = [fmt for fmt in (ImageFormat.WEBP, ImageFormat.AVIF) if is_supported(fmt)]
+
+# Encoded responses by response_key, so resubmitting a form doesn't render the card again.
+# A preview is ~50-300kB depending on the format, so this holds a few hundred.
+RESPONSE_CACHE_BYTES = 64 * 2**20
+RESPONSE_CACHE = LRUCache(maxsize=RESPONSE_CACHE_BYTES, weigh=len)
+_not_modified_lock = threading.Lock()
+not_modified_count = 0
+
+# When to load the render state: "background" in a thread while already serving, with /ready
+# saying when it's done, "1" at import, before serving (or forking), and "0" not at all. With
+# a render pool, it's loaded by its fork server (card_web_preload) as the pool starts.
+WARM_UP = os.environ.get("CARDGEN_WARM_UP", "background")
+# Every template image at LIVE_PREVIEW_SCALE is loaded up front (~1MB each, ~110MB in all), so
+# the live preview is quick from the start. The ~8MB ones at PREVIEW_SCALE are loaded as cards
+# need them, and this leaves room for a few dozen of those.
+TEMPLATE_IMAGE_CACHE_BYTES = 384 * 2**20
+# Rendered once during warm-up, for whatever gets loaded lazily on first use
+WARM_UP_CARD = {
+    "type": "event",
+    "faction": "criminal",
+    "title": "Warm-up Run",
+    "cost": "1",
+    "subtype": ["Run"],
+    "influence-cost": 1,
+    "uniqueness": False,
+    "text": "Make a run. If successful, gain 2[credit].",
+    "flavor": "Warming up.",
+    "illustrator": "Illus.: Nobody",
+}
+WEB_WARM_UP = WebWarmUp(
+    scales=(LIVE_PREVIEW_SCALE, PREVIEW_SCALE),
+    template_image_scales=(LIVE_PREVIEW_SCALE,),
+    template_image_cache_bytes=TEMPLATE_IMAGE_CACHE_BYTES,
+    card=WARM_UP_CARD,
+    formats=(ImageFormat.JPEG, *NEGOTIATED_FORMATS),
+)
+warm_state: dict = {"ready": False}
+
+# Cards are rendered in this many worker processes (0: in the request's thread), with at most
+# RENDER_QUEUE_DEPTH more waiting for one. Requests beyond that get a 503 with Retry-After, and
+# ones without a card after RENDER_TIMEOUT seconds a 504.
+RENDER_PROCESSES = int(os.environ.get("CARDGEN_RENDER_PROCESSES", os.cpu_count() or 1))
+RENDER_QUEUE_DEPTH = int(os.environ.get("CARDGEN_RENDER_QUEUE_DEPTH", 2 * RENDER_PROCESSES))
+# A card that times out while it's being drawn isn't interrupted: its worker stays busy until
+# it's done, and keeps counting against the pool (see /render-stats), so a card that never
+# finishes takes a worker for good. Nothing the form can send is known to take more than a
+# couple of seconds, so this is a backstop rather than something to tune.
+RENDER_TIMEOUT = float(os.environ.get("CARDGEN_RENDER_TIMEOUT", "20"))
+# When a worker died (e.g. out of memory), which takes the pool with it, until a new one is up
+POOL_RESTART_RETRY_AFTER = 5
+_render_pool: Optional[BoundedPool] = None
+_render_pool_lock = threading.Lock()
+
+# Cards one POST to /batch can ask for. A full size card takes ~0.3s, so this is a minute or so of one core.
+BATCH_MAX_CARDS = 200
+BATCH_FORMATS = {fmt.value: fmt for fmt in (ImageFormat.JPEG, ImageFormat.PNG, *NEGOTIATED_FORMATS)}
+# Only the scales the site itself renders at: templates keep a resized copy per scale, for good
+BATCH_SCALES = (LIVE_PREVIEW_SCALE, PREVIEW_SCALE, 1.0)
+
 
 class Faction(str, Enum):
     NBN = "nbn"
@@ -50,11 +150,118 @@ NON_ID_FACTIONS = [
 ]
 
 
+def negotiate_format(accept) -> ImageFormat:
+    """Pick the response format from the Accept header. Only formats the client names
+    explicitly count: */* doesn't mean a browser can decode AVIF."""
+    quality = {mimetype: q for mimetype, q in accept}
+    candidates = [fmt for fmt in NEGOTIATED_FORMATS if quality.get(fmt.mimetype, 0) > 0]
+    if not candidates:
+        return ImageFormat.JPEG
+    return max(candidates, key=lambda fmt: quality[fmt.mimetype])
+
+
 @app.route("/")
 def cardgen_form():
     return render_template("cardgen-form.html")
 
 
+def render_pool() -> BoundedPool:
+    """This process's render pool, started on first use and warm once all its workers are up.
+    Raises BrokenProcessPool if they can't be started, the next call tries again."""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None or _render_pool.pid != os.getpid():
+            pool = BoundedPool(
+                RENDER_PROCESSES,
+                RENDER_QUEUE_DEPTH,
+                initializer=web_worker_init,
+                initargs=(None if WARM_UP == "0" else WEB_WARM_UP,),
+                preload=() if WARM_UP == "0" else ("card_web_preload",),
+            )
+            pool.start()
+            _render_pool = pool
+        return _render_pool
+
+
+def pool_unavailable(e: Exception):
+    """503 with Retry-After for PoolBusy or BrokenProcessPool from the render pool."""
+    if isinstance(e, PoolBusy):
+        response = make_response("Too many cards being generated right now, try again in a moment", 503)
+        response.headers["Retry-After"] = str(e.retry_after)
+    else:
+        response = make_response("The card generator is restarting, try again in a moment", 503)
+        response.headers["Retry-After"] = str(POOL_RESTART_RETRY_AFTER)
+    return response
+
+
+def warm_up():
+    start = time.perf_counter()
+    if RENDER_PROCESSES:
+        try:
+            loaded = render_pool().run(web_worker_state)
+        except BrokenProcessPool as e:
+            # not ready, and requests start the pool again as they come in
+            warm_state["error"] = f"Render pool failed to start: {e}"
+            return
+    else:
+        loaded = warm_up_web(WEB_WARM_UP)
+        # the collector would otherwise write to every object it tracks, copying the shared pages in forked workers
+        gc.freeze()
+    warm_state.update(loaded, ready=True, seconds=round(time.perf_counter() - start, 2))
+
+
+if WARM_UP == "1":
+    warm_up()
+elif WARM_UP == "background":
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+else:
+    warm_state["ready"] = True
+
+
+@app.route("/ready")
+def ready():
+    """200 once the render state is loaded, 503 before."""
+    return jsonify(warm_state), 200 if warm_state["ready"] else 503
+
+
+@app.route("/cache-stats")
+def cache_stats():
+    stats = RESPONSE_CACHE.stats()
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit-rate"] = stats["hits"] / lookups if lookups else 0.0
+    stats["not-modified"] = not_modified_count
+    return jsonify(stats)
+
+
+@app.route("/render-stats")
+def render_stats():
+    """Gauges of the render pool: jobs in flight and queued, and counts of rejected and timed out ones."""
+    if _render_pool is None or _render_pool.pid != os.getpid():
+        return jsonify({"processes": RENDER_PROCESSES, "queue-depth": RENDER_QUEUE_DEPTH, "started": False})
+    return jsonify({**_render_pool.stats(), "started": True})
+
+
+class CardForm(NamedTuple):
+    """A submitted card form, validated."""
+
+    card_dict: dict
+    bg_image: Optional[Image.Image]
+    bg_bytes: Optional[bytes]
+    font_scaling_factor: float
+    make_full_art: bool
+
+
+def response_key(form: CardForm, scale: float, fmt: ImageFormat) -> str:
+    """Hash of everything the response depends on, also used as its ETag. The card dict is
+    the validated one, so forms differing only in empty or reordered fields are the same."""
+    return content_key(
+        render_cache_key(
+            form.card_dict, None, form.font_scaling_factor, form.make_full_art, "UNKNOWN_CARD_CODE", scale, fmt, "web"
+        ),
+        hashlib.sha256(form.bg_bytes).hexdigest() if form.bg_bytes is not None else None,
+    )
+
+
 def validate_and_remap(card_dict: dict) -> dict:
     card_type = card_dict.get("type")
     assert card_type, "Cards must have a type!"
@@ -182,9 +389,27 @@ def validate_and_remap(card_dict: dict) -> dict:
     return card_dict
 
 
-@app.route("/", methods=["POST"])
-def my_form_post():
+def card_from_fields(card_dict: dict) -> dict:
+    """The card to render from the fields of the form. Raises ValueError with a message for the user if it's invalid."""
+    try:
+        card_dict = validate_and_remap(card_dict)
+    except AssertionError as e:
+        raise ValueError(str(e))
+    try:
+        card_dict["influence-cost"] = int(card_dict.get("influence-cost", 0))
+    except ValueError:
+        raise ValueError(f"Invalid influence cost {card_dict.get('influence-cost')}")
+
+    if card_dict.get("subtype"):
+        card_dict["subtype"] = card_dict["subtype"].split(",")
+
+    if "illustrator" in card_dict:
+        card_dict["illustrator"] = f'Illus.: {card_dict["illustrator"]}'
+    return card_dict
+
 
+def read_card_form() -> CardForm:
+    """The card in the submitted form. Raises ValueError with a message for the user if it's invalid."""
     card_dict = {}
     for k in request.form:
         if request.form.get(k):
@@ -197,40 +422,324 @@ def my_form_post():
         try:
             bg_image = Image.open(buf)
         except Exception:
-            return "Error opening image!", 400
+            raise ValueError("Error opening image!")
+        bg_bytes = buf.getvalue()
     else:
-        bg_image = None
+        bg_image = bg_bytes = None
+
+    return CardForm(
+        card_from_fields(card_dict),
+        bg_image,
+        bg_bytes,
+        font_scaling_factor=float(request.form.get("font-scaling-factor", "1.0")),
+        make_full_art=bool(request.form.get("full-art")),
+    )
+
 
+def render_args(form: CardForm, scale: float, fmt: ImageFormat) -> tuple:
+    """render_web_card's arguments for a form. Workers open the background's bytes again, so
+    the decoded image isn't sent. Previews decode JPEG backgrounds at a reduced DCT scale."""
+    return (
+        form.card_dict, form.bg_bytes, form.font_scaling_factor, form.make_full_art, scale, fmt, scale < PREVIEW_SCALE
+    )
+
+
+def card_response(scale: float):
+    """The submitted card drawn at scale, from RESPONSE_CACHE if it's been drawn before."""
     try:
-        card_dict = validate_and_remap(card_dict)
-    except AssertionError as e:
+        form = read_card_form()
+    except ValueError as e:
         return str(e), 400
+
+    fmt = negotiate_format(request.accept_mimetypes)
+    key = response_key(form, scale, fmt)
+
+    if request.if_none_match.contains(key):
+        global not_modified_count
+        with _not_modified_lock:
+            not_modified_count += 1
+        response = make_response("", 304)
+    else:
+
+        def render():
+            if not RENDER_PROCESSES:
+                return render_web_card(*render_args(form, scale, fmt))
+            return render_pool().run(render_web_card, *render_args(form, scale, fmt), timeout=RENDER_TIMEOUT)
+
+        try:
+            data = RESPONSE_CACHE.get(key, render)
+        except (PoolBusy, BrokenProcessPool) as e:
+            return pool_unavailable(e)
+        except TimeoutError:
+            return f"Generating the card took more than {RENDER_TIMEOUT:g}s", 504
+        response = make_response(data)
+        response.headers["Content-Type"] = fmt.mimetype
+    response.set_etag(key)
+    response.headers["Vary"] = "Accept"
+    return response
+
+
+@app.route("/", methods=["POST"])
+def my_form_post():
+    return card_response(PREVIEW_SCALE)
+
+
+@app.route("/preview", methods=["POST"])
+def preview():
+    """A quick low resolution render of the form, for showing while it's being edited."""
+    return card_response(LIVE_PREVIEW_SCALE)
+
+
+class BatchCard(NamedTuple):
+    """A card of a batch, with what to name its file. Cards which aren't valid have an error instead of a form."""
+
+    index: int
+    name: str
+    title: Optional[str]
+    form: Optional[CardForm]
+    error: Optional[str]
+
+
+# Form fields which are checkboxes, true or missing
+BATCH_CHECKBOXES = {"uniqueness", "full-art"}
+
+
+def batch_fields(card: dict) -> dict:
+    """A card of a batch as the fields the form would have sent: strings, without the empty ones.
+    Lists (of subtypes) are joined by commas, and the checkboxes stay booleans."""
+    fields = {}
+    for k, v in card.items():
+        if v is None or v is False or v == "" or v == []:
+            continue
+        if isinstance(v, list):
+            v = ",".join(str(item) for item in v)
+        elif not (isinstance(v, str) or isinstance(v, bool) and k in BATCH_CHECKBOXES):
+            v = str(v)
+        fields[k] = v
+    return fields
+
+
+def read_batch(body) -> tuple[list[BatchCard], float, ImageFormat]:
+    """The cards, scale and format of a batch request. Raises ValueError if the request as a whole
+    is invalid, while invalid cards only get their error in their BatchCard."""
+    if not isinstance(body, dict) or not isinstance(body.get("cards"), list):
+        raise ValueError('Expected a JSON object with a list of "cards"')
+    if not 0 < len(body["cards"]) <= BATCH_MAX_CARDS:
+        raise ValueError(f"A batch has 1 to {BATCH_MAX_CARDS} cards")
+    # null, here and in the cards, is the same as leaving the option out
+    fmt = body.get("format") or "jpeg"
+    fmt = BATCH_FORMATS.get(fmt) if isinstance(fmt, str) else None
+    if fmt is None:
+        raise ValueError(f"The format must be one of {', '.join(BATCH_FORMATS)}")
+    scale = body.get("scale")
+    scale = PREVIEW_SCALE if scale is None else scale
+    if isinstance(scale, bool) or scale not in BATCH_SCALES:
+        raise ValueError(f"The scale must be one of {', '.join(f'{s:g}' for s in BATCH_SCALES)}")
     try:
-        card_dict["influence-cost"] = int(card_dict.get("influence-cost", 0))
-    except ValueError:
-        return f"Invalid influence cost {card_dict.get('influence-cost')}", 400
+        font_scaling_factor = body.get("font-scaling-factor")
+        font_scaling_factor = 1.0 if font_scaling_factor is None else float(font_scaling_factor)
+    except (TypeError, ValueError):
+        raise ValueError("font-scaling-factor must be a number")
+    make_full_art = bool(body.get("full-art"))
+
+    batch = []
+    for index, card in enumerate(body["cards"]):
+        name = f"{index + 1:03d}"
+        title = None
+        try:
+            if not isinstance(card, dict):
+                raise ValueError("A card must be a JSON object")
+            title = card.get("title")
+            if slug := re.sub(r"[^A-Za-z0-9]+", "-", str(title or "")).strip("-").lower()[:60]:
+                name += f"-{slug}"
+            fields = batch_fields(card)
+            if "bg-image" in fields:
+                raise ValueError("Background images can't be sent in a batch")
+            card_font_scaling_factor = card.get("font-scaling-factor")
+            try:
+                card_font_scaling_factor = float(
+                    font_scaling_factor if card_font_scaling_factor is None else card_font_scaling_factor
+                )
+            except (TypeError, ValueError):
+                raise ValueError("font-scaling-factor must be a number")
+            form = CardForm(
+                card_from_fields(fields),
+                None,
+                None,
+                font_scaling_factor=card_font_scaling_factor,
+                make_full_art=make_full_art if card.get("full-art") is None else bool(card["full-art"]),
+            )
+        except (TypeError, ValueError) as e:
+            batch.append(BatchCard(index, name, title, None, str(e)))
+        else:
+            batch.append(BatchCard(index, name, title, form, None))
+    return batch, scale, fmt
+
+
+def render_error(e: Exception) -> str:
+    if isinstance(e, TimeoutError):
+        return f"Generating the card took more than {RENDER_TIMEOUT:g}s"
+    if isinstance(e, BrokenProcessPool):
+        return "The card generator restarted while generating the card"
+    return f"{type(e).__name__}: {e}"
+
+
+def render_batch(
+    batch: list[BatchCard], scale: float, fmt: ImageFormat
+) -> Iterator[tuple[BatchCard, Optional[bytes], Optional[str]]]:
+    """Render the cards of a batch, yielding (card, encoded image, error) as each is done, invalid cards first.
+    At most RENDER_PROCESSES of them are in the render pool at a time, so a batch doesn't crowd out the form."""
+    todo = deque()
+    for card in batch:
+        if card.form is None:
+            yield card, None, card.error
+        else:
+            todo.append(card)
+
+    if not RENDER_PROCESSES:
+        for card in todo:
+            try:
+                data = render_web_card(*render_args(card.form, scale, fmt))
+            except Exception as e:
+                yield card, None, render_error(e)
+            else:
+                yield card, data, None
+        return
+
+    pool = render_pool()
+    running = {}  # future: (card, deadline)
+    busy_since = None  # when the pool was last full with nothing of this batch's in it
+    try:
+        while todo or running:
+            while todo and len(running) < RENDER_PROCESSES:
+                try:
+                    future = pool.submit(render_web_card, *render_args(todo[0].form, scale, fmt))
+                except BrokenProcessPool as e:
+                    # the pool has a new executor by now, the rest of the batch can go on
+                    yield todo.popleft(), None, render_error(e)
+                    continue
+                except PoolBusy as e:
+                    if running:
+                        break  # there's room again when one of ours is done
+                    busy_since = busy_since or time.monotonic()
+                    if time.monotonic() - busy_since > RENDER_TIMEOUT:
+                        yield todo.popleft(), None, "Too many cards being generated right now"
+                        busy_since = None
+                    else:
+                        time.sleep(min(e.retry_after, 1))
+                    continue
+                busy_since = None
+                running[future] = (todo.popleft(), time.monotonic() + RENDER_TIMEOUT)
+            if not running:
+                continue
+
+            first_deadline = min(deadline for _, deadline in running.values())
+            done, _ = wait(running, timeout=max(0.0, first_deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            for future, (card, deadline) in list(running.items()):
+                if future not in done and deadline > now:
+                    continue
+                del running[future]
+                try:
+                    # timeout=0 for the ones past their deadline, which times them out
+                    data = pool.result(future, timeout=0)
+                except Exception as e:
+                    yield card, None, render_error(e)
+                else:
+                    yield card, data, None
+    finally:
+        # the client went away, or something went wrong: don't render the rest
+        for future in running:
+            future.cancel()
+
+
+class _ChunkWriter:
+    """A write-only file keeping what's written until it's taken, for streaming a ZipFile."""
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
 
-    if card_dict.get("subtype"):
-        card_dict["subtype"] = card_dict["subtype"].split(",")
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
 
-    if "illustrator" in card_dict:
-        card_dict["illustrator"] = f'Illus.: {card_dict["illustrator"]}'
 
-    font_scaling_factor = float(request.form.get("font-scaling-factor", "1.0"))
-    make_full_art = request.form.get("full-art")
-    card_img = make_card_proxy(card_dict, None, fudge_factor=font_scaling_factor, make_alt=make_full_art)
-    out_buf = BytesIO()
-    newsize = tuple(map(lambda x: round(0.7 * x), card_img.size))
-    card_img = card_img.resize(newsize).convert("RGBA")
+def batch_result(card: BatchCard, file_name: str, error: Optional[str]) -> dict:
+    result = {"index": card.index, "title": card.title}
+    if error is None:
+        result["file"] = file_name
+    else:
+        result["error"] = error
+    return result
+
+
+def zip_stream(results, fmt: ImageFormat) -> Iterator[bytes]:
+    """A ZIP of the cards, written as they come, with an NNN-title.error.txt for each card that
+    failed and a results.json listing them all at the end."""
+    out = _ChunkWriter()
+    listing = []
+    # the images are compressed already
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_STORED) as archive:
+        for card, data, error in results:
+            file_name = f"{card.name}{fmt.suffix}" if error is None else f"{card.name}.error.txt"
+            archive.writestr(file_name, data if error is None else error)
+            listing.append(batch_result(card, file_name, error))
+            yield out.take()
+        archive.writestr("results.json", json.dumps(sorted(listing, key=lambda r: r["index"]), indent=1))
+    yield out.take()
+
+
+def multipart_stream(results, fmt: ImageFormat, boundary: str) -> Iterator[bytes]:
+    """A multipart/mixed body with a part for each card as it comes: the image, or a JSON error."""
+    for card, data, error in results:
+        if error is None:
+            content_type, file_name, body = fmt.mimetype, f"{card.name}{fmt.suffix}", data
+        else:
+            content_type, file_name = "application/json", f"{card.name}.error.json"
+            body = json.dumps(batch_result(card, file_name, error)).encode()
+        headers = f"Content-Type: {content_type}\r\nContent-Disposition: attachment; filename=\"{file_name}\""
+        yield f"--{boundary}\r\n{headers}\r\n\r\n".encode() + body + b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
 
-    if bg_image:
-        bg_image = bg_image.resize(card_img.size).convert("RGBA")
-        bg_image.paste(card_img, mask=card_img)
-        card_img = bg_image
+@app.route("/batch", methods=["POST"])
+def batch():
+    """Render a list of cards in the form's fields, streaming them back as each is done.
 
-    card_img.convert("RGB").save(out_buf, format="jpeg", quality=85)
-    img_bytes = out_buf.getvalue()
+        {"cards": [{"type": "event", "faction": "criminal", "title": "Sure Gamble", ...}, ...],
+         "scale": 0.7, "format": "jpeg", "font-scaling-factor": 1.0, "full-art": false}
 
-    response = make_response(img_bytes)
-    response.headers["Content-Type"] = "image/jpeg"
-    return response, 200
+    The options apply to every card, and cards can set font-scaling-factor and full-art
+    themselves. The scale is one of BATCH_SCALES. The response is a ZIP, or multipart/mixed
+    if the client asks for it. A card which is invalid or fails to render gets an error in
+    its place rather than failing the batch.
+    """
+    try:
+        cards, scale, fmt = read_batch(request.get_json(silent=True))
+    except ValueError as e:
+        return str(e), 400
+    if RENDER_PROCESSES:
+        try:
+            pool = render_pool()
+        except BrokenProcessPool as e:
+            return pool_unavailable(e)
+        if pool.is_full():
+            return pool_unavailable(PoolBusy(pool.retry_after()))
+
+    results = render_batch(cards, scale, fmt)
+    if request.accept_mimetypes.best_match(["application/zip", "multipart/mixed"]) == "multipart/mixed":
+        boundary = uuid.uuid4().hex
+        return Response(multipart_stream(results, fmt, boundary), mimetype=f"multipart/mixed; boundary={boundary}")
+    return Response(
+        zip_stream(results, fmt),
+        mimetype="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="cards.zip"'},
+    )